@@ -5,33 +5,45 @@ import json
 
 import japi
 from helpers.error import error
-from helpers.api import route, param, login
+from helpers.api import route, params, Field, login
 from helpers.format import format_account
 
-from singletons import rds
+from singletons import rds, mysql_conn
+from helpers import breaker
+from helpers import cache
+from helpers import response_cache
+from helpers import reloader
+from helpers import auth
+from helpers.limiter import limiter
+from helpers import singleflight
+from helpers.singleflight import coalesce
 from dao import account as dao_account
 
-# sample router
+# load shedding priorities (critical, normal, low), unlisted routes are normal
+PRIORITIES = {
+    'GET': [
+        ('^sleep$', 'low'),
+        ('^samples$', 'low'),
+        ('^metrics$', 'critical'),
+    ],
+}
+
+# full response cache, write paths purge it with dao_account.invalidate_account
+RESPONSE_CACHE = {
+    'GET': [
+        ('^samples$', {'ttl': 30, 'tag': 'accounts'}),
+    ],
+}
+
+# sample router, ROUTES is declared at the bottom so japi.warmup can precompile it
 def index(args, me, meta):
-    routes = {
-        'GET': [
-            ('^sleep$', sleep),
-            ('^noop$', noop),
-            ('^echo\/(?P<foo>.+)$', echo, {'myvar': 'bar'}),
-            ('^sample\/(?P<account_id>.+)$', get_account),
-        ],
-        'POST': [
-            ('^multiapi$', multiapi),
-        ]
-    }
-    return route(routes, args, me, meta)
+    return route(ROUTES, args, me, meta)
 
 #sample apis
-@param('duration', False, lambda x: x in ['short', 'long'] and x or error(10010, {'duration': x}))
+@params(duration=Field(choices=['short', 'long'], default='short'))
 def sleep(args, me, meta):
     start = time.time()
-    duration = args.get('duration') or 'short'
-    if duration == 'short':
+    if args['duration'] == 'short':
         time.sleep(1)
     else:
         time.sleep(10)
@@ -44,7 +56,7 @@ def sleep(args, me, meta):
 def noop(args, me, meta):
     return
 
-@param('apis', True, str)
+@params(apis=Field(required=True))
 def multiapi(args, me, meta):
     apis = json.loads(args['apis'])
     ip = args['ip']
@@ -62,11 +74,44 @@ def multiapi(args, me, meta):
         responses.append(apires)
     return responses
 
-@param('foo', True, str)
+@params(foo=Field(required=True))
 def echo(args, me, meta):
     meta['force_txt'] = True
     return (args['foo'] + args['myvar'])
 
-@param('account_id', True, str)
+@login
+def metrics(args, me, meta):
+    return {
+        'breakers': breaker.stats(),
+        'mysql': mysql_conn.node_stats(),
+        'cache': cache.stats(),
+        'limiter': limiter.get_stats(),
+        'singleflight': singleflight.stats(),
+        'response_cache': response_cache.stats(),
+        'reloader': reloader.stats(),
+        'auth': auth.stats(),
+    }
+
+@params(account_id=Field(required=True))
 def get_account(args, me, meta):
-    return format_account(dao_account.get_account_by_id(args['account_id']))
+    return format_account(dao_account.get_account_by_id(args['account_id'], meta['fields']), meta['fields'])
+
+@coalesce()
+@params(cursor=Field(), limit=Field(int, min=1, max=100, default=20))
+def list_accounts(args, me, meta):
+    accounts, meta['next_cursor'] = dao_account.get_accounts_page(args['cursor'], args['limit'], meta['fields'])
+    return [format_account(account, meta['fields']) for account in accounts]
+
+ROUTES = {
+    'GET': [
+        ('^sleep$', sleep),
+        ('^noop$', noop),
+        ('^echo\/(?P<foo>.+)$', echo, {'myvar': 'bar'}),
+        ('^sample\/(?P<account_id>.+)$', get_account),
+        ('^samples$', list_accounts),
+        ('^metrics$', metrics),
+    ],
+    'POST': [
+        ('^multiapi$', multiapi),
+    ]
+}
@@ -6,10 +6,39 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import config
 from singletons import mysql_conn
+from helpers.cache import cached, invalidate
+from helpers.loader import Loader
+from helpers.paginate import fetch_page
 
 #no ORM here, the idea is to wrap your db queries into functions before using them 
 
+#columns a fields= projection may select, anything else is rejected with 10010
+ACCOUNT_COLUMNS = frozenset(['id', 'name', 'email', 'mobile', 'created_at'])
+
 #sample
-def get_account_by_id(user_id):
-    account = mysql_conn.fetch_one('select * from users where id = %s limit 1', (user_id, ))
+#write paths touching users must call invalidate_account(user_id), it also purges cached account lists
+@cached(ttl=300, tags=['account:{0}'])
+def get_account_by_id(user_id, fields=None):
+    columns = mysql_conn.columns(fields, required=('id', ), allowed=ACCOUNT_COLUMNS)
+    account = mysql_conn.fetch_one('select ' + columns + ' from users where id = %s limit 1', (user_id, ))
     return account
+
+#batch form, one round trip for a whole list of ids
+def get_accounts_by_ids(user_ids, fields=None):
+    if not user_ids:
+        return {}
+    columns = mysql_conn.columns(fields, required=('id', ), allowed=ACCOUNT_COLUMNS)
+    placeholders = ', '.join(['%s'] * len(user_ids))
+    accounts = mysql_conn.fetch_all('select ' + columns + ' from users where id in (' + placeholders + ')', tuple(user_ids))
+    return dict((account['id'], account) for account in accounts)
+
+account_loader = Loader(get_accounts_by_ids)
+
+#newest first, returns (accounts, next_cursor)
+def get_accounts_page(cursor=None, limit=20, fields=None):
+    columns = mysql_conn.columns(fields, required=('id', ), allowed=ACCOUNT_COLUMNS)
+    return fetch_page('select ' + columns + ' from users', None, None, [('id', 'desc')], cursor, limit)
+
+def invalidate_account(user_id):
+    invalidate('account:%s' % user_id, 'accounts')
+    account_loader.clear()
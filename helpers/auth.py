@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import hmac
+import time
+import base64
+import hashlib
+import threading
+
+import redis
+
+import config
+from helpers.cache import LRUCache, MISS
+from singletons import rds, REDIS_ERRORS
+
+#signed tokens: kind.id.issued_ms.expires.signature, kind is 'a' for accounts and 's' for session ids.
+#the HMAC is checked without any I/O and verified tokens sit in a per worker LRU, so a request
+#only pays a dict lookup. revoke(account_id) invalidates every token issued to the account before
+#now: the cut off is kept in a redis hash and published on a channel every worker listens to from a
+#thread (uwsgi needs enable-threads). the hash is also re-read every AUTH_REVOKED_SYNC seconds, which
+#covers messages missed while the listener reconnects and workers running without threads.
+#the full account record is only loaded when a handler reads a field of me other than id.
+
+TOKEN_SECRET = getattr(config, 'TOKEN_SECRET', '')
+TOKEN_TTL = getattr(config, 'TOKEN_TTL', 30 * 86400)
+AUTH_CACHE_SIZE = getattr(config, 'AUTH_CACHE_SIZE', 10000)
+AUTH_CACHE_TTL = getattr(config, 'AUTH_CACHE_TTL', 300)
+AUTH_REVOKED_SYNC = getattr(config, 'AUTH_REVOKED_SYNC', 30)
+REVOKED_KEY = 'auth:revoked'
+REVOKE_CHANNEL = 'auth:revoke'
+
+_verified = LRUCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+_revoked = {} #account id -> tokens issued before this time are invalid
+_listener = {'pid': None, 'synced': 0}
+
+class Me(dict):
+    #id and is_session_id are always there, any other field loads the account record once
+
+    def __init__(self, account_id, is_session_id=False):
+        dict.__init__(self, id=account_id, is_session_id=is_session_id)
+        self._loaded = is_session_id
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        from dao.account import get_account_by_id
+        account = get_account_by_id(self['id'])
+        if account:
+            for k, v in account.iteritems():
+                self.setdefault(k, v)
+
+    def __missing__(self, key):
+        self._load()
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if not dict.__contains__(self, key):
+            self._load()
+        return dict.get(self, key, default)
+
+def _sign(payload):
+    return base64.urlsafe_b64encode(hmac.new(TOKEN_SECRET, payload, hashlib.sha256).digest()[:18])
+
+def issue(account_id, ttl=TOKEN_TTL, is_session_id=False):
+    now = time.time()
+    payload = '%s.%d.%d.%d' % (is_session_id and 's' or 'a', int(account_id), int(now * 1000), int(now + ttl))
+    return payload + '.' + _sign(payload)
+
+def _parse(token):
+    try:
+        payload, signature = token.rsplit('.', 1)
+        kind, account_id, issued, expires = payload.split('.')
+        account_id = int(account_id)
+        issued = int(issued)
+        expires = int(expires)
+    except ValueError:
+        return None
+    if kind not in ('a', 's') or not hmac.compare_digest(_sign(payload), signature):
+        return None
+    return account_id, kind == 's', issued, expires
+
+def _on_revoke(account_id, before):
+    if before > _revoked.get(account_id, 0):
+        _revoked[account_id] = before
+
+def _listen():
+    #its own connection: the shared pool's socket timeout would drop an idle subscription every second
+    conn = redis.Redis(**dict(config.REDIS, socket_timeout=None))
+    while True:
+        try:
+            p = conn.pubsub(ignore_subscribe_messages=True)
+            p.subscribe(REVOKE_CHANNEL)
+            for message in p.listen():
+                if message['type'] == 'message':
+                    account_id, before = message['data'].split(':')
+                    _on_revoke(int(account_id), float(before))
+        except Exception:
+            time.sleep(1)
+
+def _sync_revoked(now):
+    _listener['synced'] = now
+    try:
+        for account_id, before in rds.hgetall(REVOKED_KEY).iteritems():
+            _on_revoke(int(account_id), float(before))
+    except REDIS_ERRORS:
+        pass
+
+def _start_listener(now):
+    #once per worker, after fork
+    pid = os.getpid()
+    if _listener['pid'] == pid:
+        if now - _listener['synced'] > AUTH_REVOKED_SYNC:
+            _sync_revoked(now)
+        return
+    _listener['pid'] = pid
+    _sync_revoked(now)
+    t = threading.Thread(target=_listen, name='auth-revoke')
+    t.daemon = True
+    t.start()
+
+def verify(token):
+    if not TOKEN_SECRET or not token:
+        return None
+    now = time.time()
+    _start_listener(now)
+    entry = _verified.get(token)
+    if entry is MISS:
+        entry = _parse(token)
+        if entry is None:
+            return None
+        if entry[3] <= now:
+            return None
+        _verified.set(token, entry, min(AUTH_CACHE_TTL, entry[3] - now))
+    account_id, is_session_id, issued, expires = entry
+    if expires <= now or issued < _revoked.get(account_id, 0) * 1000:
+        return None
+    return Me(account_id, is_session_id)
+
+def revoke(account_id):
+    #every token issued to account_id until now stops verifying in every worker
+    now = time.time()
+    _on_revoke(account_id, now)
+    p = rds.pipeline()
+    p.hset(REVOKED_KEY, account_id, now)
+    p.publish(REVOKE_CHANNEL, '%d:%f' % (account_id, now))
+    p.execute()
+
+def prune_revoked():
+    #cut offs older than TOKEN_TTL can't match a live token any more
+    limit = time.time() - TOKEN_TTL
+    stale = [k for k, v in rds.hgetall(REVOKED_KEY).iteritems() if float(v) < limit]
+    if stale:
+        rds.hdel(REVOKED_KEY, *stale)
+
+def stats():
+    return {'verified': len(_verified.data), 'revoked': len(_revoked)}
+
+if __name__ == '__main__':
+    import timeit
+
+    TOKEN_SECRET = 'bench'
+    token = issue(42)
+    me = verify(token)
+    assert me['id'] == 42 and not me.get('is_session_id')
+    assert verify(token[:-2] + 'xx') is None
+    assert verify(issue(42, ttl=-1)) is None
+    assert verify(issue(7, is_session_id=True))['is_session_id']
+    n = 100000
+    print 'verify, cache hit   %.1fus' % (min(timeit.repeat(lambda: verify(token), number=n, repeat=3)) / n * 1e6)
+    print 'verify, hmac only   %.1fus' % (min(timeit.repeat(lambda: _parse(token), number=n, repeat=3)) / n * 1e6)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import time
+
+import config
+from helpers.error import CustomError
+
+#circuit breakers for MySQL, Redis and mail
+#closed: calls pass, failures are counted over a rolling window
+#open: calls fail fast with CircuitOpen until reset_timeout has passed
+#half open: one probe call at a time, success closes the breaker, failure opens it again
+
+BREAKER_WINDOW = getattr(config, 'BREAKER_WINDOW', 10)
+BREAKER_MIN_CALLS = getattr(config, 'BREAKER_MIN_CALLS', 5)
+BREAKER_FAILURE_RATE = getattr(config, 'BREAKER_FAILURE_RATE', 0.5)
+BREAKER_RESET_TIMEOUT = getattr(config, 'BREAKER_RESET_TIMEOUT', 5)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+breakers = {}
+
+class CircuitOpen(CustomError):
+    def __init__(self, name):
+        CustomError.__init__(self, 10038, {'dependency': name})
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, errors=(Exception, ), window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 failure_rate=BREAKER_FAILURE_RATE, reset_timeout=BREAKER_RESET_TIMEOUT, is_failure=None):
+        self.name = name
+        self.errors = errors
+        #narrows errors further, e.g. by errno: errors it rejects count as an answer from the dependency
+        self.is_failure = is_failure
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.opened_at = 0
+        self.probing = False
+        self.window_start = time.time()
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.trips = 0
+        breakers[name] = self
+
+    def is_open(self):
+        return self.state == OPEN and time.time() - self.opened_at < self.reset_timeout
+
+    def allow(self):
+        now = time.time()
+        if self.state == OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            self.probing = False
+        if self.state == HALF_OPEN:
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+        if now - self.window_start > self.window:
+            self.window_start = now
+            self.calls = 0
+            self.failures = 0
+        return True
+
+    def before(self):
+        if not self.allow():
+            self.rejected += 1
+            raise CircuitOpen(self.name)
+
+    def success(self):
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+            self.probing = False
+            self.window_start = time.time()
+            self.calls = 0
+            self.failures = 0
+        else:
+            self.calls += 1
+
+    def failure(self):
+        self.calls += 1
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.calls >= self.min_calls and
+                                       self.failures >= self.calls * self.failure_rate):
+            self.state = OPEN
+            self.opened_at = time.time()
+            self.probing = False
+            self.trips += 1
+
+    def call(self, func, *args, **kwargs):
+        self.before()
+        try:
+            rlt = func(*args, **kwargs)
+        except self.errors, e:
+            if self.is_failure is None or self.is_failure(e):
+                self.failure()
+            else:
+                self.success()
+            raise
+        except:
+            #anything else means the dependency answered
+            self.success()
+            raise
+        self.success()
+        return rlt
+
+    def get_stats(self):
+        return {
+            'state': self.state,
+            'calls': self.calls,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'trips': self.trips,
+        }
+
+def stats():
+    return dict((name, b.get_stats()) for name, b in breakers.iteritems())
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import time
+import hashlib
+import cPickle
+from collections import OrderedDict
+from functools import wraps
+
+import config
+from singletons import rds, REDIS_ERRORS
+
+#two tier read-through cache: per-worker LRU in front of redis
+#local entries are only purged on the worker doing the invalidation, keep local_ttl short
+#with redis down a cached function still answers from its source, without the lock and the store
+
+MISS = object()
+TAG_PREFIX = 'cache:tag:'
+LOCAL_BACKEND = getattr(config, 'CACHE_LOCAL_BACKEND', 'lru') #'shm' shares the local tier between workers
+
+_local_caches = []
+_stats = {}
+
+class LRUCache(object):
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.tags = {}
+
+    def get(self, key):
+        item = self.data.pop(key, None)
+        if item is None:
+            return MISS
+        value, expire_at, tags = item
+        if expire_at < time.time():
+            self._untag(key, tags)
+            return MISS
+        self.data[key] = item
+        return value
+
+    def set(self, key, value, ttl=None, tags=()):
+        self.delete(key)
+        self.data[key] = (value, time.time() + (ttl or self.ttl), tags)
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(key)
+        while len(self.data) > self.maxsize:
+            old_key, item = self.data.popitem(last=False)
+            self._untag(old_key, item[2])
+
+    def delete(self, key):
+        item = self.data.pop(key, None)
+        if item is not None:
+            self._untag(key, item[2])
+
+    def _untag(self, key, tags):
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def invalidate(self, tag):
+        for key in self.tags.pop(tag, ()):
+            self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+        self.tags.clear()
+
+def register_local(local):
+    #local tiers registered here are purged by invalidate() too
+    if local not in _local_caches:
+        _local_caches.append(local)
+
+def make_local(maxsize, ttl):
+    if LOCAL_BACKEND == 'shm':
+        from helpers.shmcache import get_shared
+        local = get_shared(ttl)
+    else:
+        local = LRUCache(maxsize, ttl)
+    register_local(local)
+    return local
+
+def dumps(value):
+    return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+def loads(data):
+    return cPickle.loads(data)
+
+def make_key(prefix, f, args, kwargs):
+    digest = hashlib.md5(repr((args, sorted(kwargs.items())))).hexdigest()
+    return '%s:%s.%s:%s' % (prefix, f.__module__, f.__name__, digest)
+
+def _record(name, field, cost=None):
+    s = _stats.get(name)
+    if s is None:
+        s = _stats[name] = {'hit_local': 0, 'hit_redis': 0, 'miss': 0, 'wait': 0, 'time': 0.0}
+    s[field] += 1
+    if cost is not None:
+        s['time'] += cost
+
+def stats():
+    return dict((name, dict(s)) for name, s in _stats.iteritems())
+
+#a tag set lives as long as its longest lived key, a shorter ttl never cuts it down
+_extend_ttl = rds.register_script('''
+local ttl = redis.call('ttl', KEYS[1])
+if ttl < tonumber(ARGV[1]) then
+    redis.call('expire', KEYS[1], ARGV[1])
+end
+''')
+
+def store(key, value, ttl, tags=()):
+    p = rds.pipeline()
+    p.set(key, dumps(value), ex=ttl)
+    for tag in tags:
+        p.sadd(TAG_PREFIX + tag, key)
+        _extend_ttl(keys=[TAG_PREFIX + tag], args=[ttl], client=p)
+    p.execute()
+
+def _wait_for(key, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(0.01)
+        data = rds.get(key)
+        if data is not None:
+            return loads(data)
+    return MISS
+
+def cached(ttl=300, local_ttl=5, tags=(), maxsize=1024, lock_ttl=5, prefix='cache'):
+    #tags are format strings over the call arguments, e.g. 'account:{0}'
+    def decorator(f):
+        local = make_local(maxsize, local_ttl)
+        name = '%s.%s' % (f.__module__, f.__name__)
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            key = make_key(prefix, f, args, kwargs)
+            key_tags = [t.format(*args, **kwargs) for t in tags]
+
+            value = local.get(key)
+            if value is not MISS:
+                _record(name, 'hit_local', time.time() - start)
+                return value
+
+            lock_key = key + ':lock'
+            locked = False
+            try:
+                data = rds.get(key)
+                if data is not None:
+                    value = loads(data)
+                    local.set(key, value, local_ttl, key_tags)
+                    _record(name, 'hit_redis', time.time() - start)
+                    return value
+
+                #stampede protection, only the lock holder recomputes
+                locked = rds.set(lock_key, 1, nx=True, ex=lock_ttl)
+                if not locked:
+                    value = _wait_for(key, lock_ttl)
+                    if value is not MISS:
+                        local.set(key, value, local_ttl, key_tags)
+                        _record(name, 'wait', time.time() - start)
+                        return value
+                use_redis = True
+            except REDIS_ERRORS:
+                use_redis = False
+            try:
+                value = f(*args, **kwargs)
+                if use_redis:
+                    try:
+                        store(key, value, ttl, key_tags)
+                    except REDIS_ERRORS:
+                        pass
+            finally:
+                if locked:
+                    try:
+                        rds.delete(lock_key)
+                    except REDIS_ERRORS:
+                        pass
+            local.set(key, value, local_ttl, key_tags)
+            _record(name, 'miss', time.time() - start)
+            return value
+
+        wrapper.local_cache = local
+        return wrapper
+    return decorator
+
+def invalidate(*tags):
+    p = rds.pipeline()
+    for tag in tags:
+        for key in rds.smembers(TAG_PREFIX + tag):
+            p.delete(key)
+        p.delete(TAG_PREFIX + tag)
+        for local in _local_caches:
+            local.invalidate(tag)
+    p.execute()
+
+if __name__ == '__main__':
+    c = LRUCache(2, 60)
+    c.set('a', 1, tags=['t'])
+    c.set('b', 2)
+    assert c.get('a') == 1
+    c.set('c', 3)
+    assert c.get('b') is MISS
+    c.invalidate('t')
+    assert c.get('a') is MISS
+    assert c.get('c') == 3
+    c.set('d', None, ttl=-1)
+    assert c.get('d') is MISS
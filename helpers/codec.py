@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+
+try:
+    import msgpack
+except ImportError: #msgpack is optional, JSON is always available
+    msgpack = None
+
+JSON_CONTENT_TYPE = 'application/json; charset=utf-8'
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+
+#wire formats, objects passed in here should already be realize()d
+#a python 2 str is text in this code base (keys, realize()d dates, messages), so msgpack gets no bin type:
+#str and unicode both go out as msgpack str, like they do in json
+
+def accepts_msgpack(environ):
+    return msgpack is not None and MSGPACK_CONTENT_TYPE in environ.get('HTTP_ACCEPT', '')
+
+def encode(obj, use_msgpack=False):
+    if use_msgpack and msgpack is not None:
+        return msgpack.packb(obj, use_bin_type=False), MSGPACK_CONTENT_TYPE
+    return json.dumps(obj), JSON_CONTENT_TYPE
+
+def decode_msgpack(data):
+    if msgpack is None:
+        raise ValueError('msgpack is not installed')
+    return msgpack.unpackb(data, raw=False)
+
+if __name__ == '__main__':
+    import datetime
+    import timeit
+    from decimal import Decimal
+    from helpers.util import realize
+
+    def shape(obj):
+        #types all the way down, == alone passes when a str came back as bytes
+        if isinstance(obj, dict):
+            return dict((shape(k), shape(v)) for k, v in obj.iteritems())
+        if isinstance(obj, list):
+            return [shape(v) for v in obj]
+        return type(obj)
+
+    #something shaped like a fetch_all() result
+    rows = [{
+        'id': i,
+        'name': u'user_%d' % i,
+        'email': u'user_%d@mydomain.com' % i,
+        'balance': Decimal('1234.56'),
+        'is_active': i % 2,
+        'created_at': datetime.datetime(2015, 1, 1, 12, 0, 0),
+    } for i in xrange(10000)]
+    payload = realize({'meta': {'status': 0, 'server_time': '2015-01-01 12:00:00', 'errmsg': ''}, 'data': rows})
+
+    json_body, _ = encode(payload)
+    print 'json    %8d bytes  %.4fs' % (len(json_body), min(timeit.repeat(lambda: encode(payload), number=10, repeat=3)) / 10)
+    if msgpack is None:
+        print 'msgpack not installed'
+    else:
+        msgpack_body, _ = encode(payload, True)
+        decoded = decode_msgpack(msgpack_body)
+        assert decoded == json.loads(json_body)
+        assert shape(decoded) == shape(json.loads(json_body))
+        print 'msgpack %8d bytes  %.4fs' % (len(msgpack_body), min(timeit.repeat(lambda: encode(payload, True), number=10, repeat=3)) / 10)
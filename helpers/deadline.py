@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import time
+
+import config
+from helpers.error import error
+
+#request scoped deadlines, process_action starts one per request and every
+#dependency call (MySQL, outbound HTTP) gets whatever budget is left
+
+REQUEST_DEADLINE = getattr(config, 'REQUEST_DEADLINE', 10.0)
+HTTP_CONNECT_TIMEOUT = getattr(config, 'HTTP_CONNECT_TIMEOUT', 3.05)
+HTTP_READ_TIMEOUT = getattr(config, 'HTTP_READ_TIMEOUT', 30.0) #outside of requests
+HTTP_MIN_TIMEOUT = 0.1
+
+_deadlines = []
+
+def start(seconds=None):
+    #nested requests (multiapi) never get more time than their parent
+    at = time.time() + (seconds or REQUEST_DEADLINE)
+    if _deadlines:
+        at = min(at, _deadlines[-1])
+    _deadlines.append(at)
+    return at
+
+def end():
+    if _deadlines:
+        _deadlines.pop()
+
+def narrow(seconds):
+    if _deadlines:
+        _deadlines[-1] = min(_deadlines[-1], time.time() + seconds)
+
+def remaining():
+    if not _deadlines:
+        return None
+    return _deadlines[-1] - time.time()
+
+def check():
+    left = remaining()
+    if left is not None and left <= 0:
+        error(10037, {'exceeded': round(-left, 3)})
+    return left
+
+def http_timeout():
+    #(connect, read) for requests, never raises: callers that must fail fast call check() first
+    left = remaining()
+    if left is None:
+        return HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+    left = max(left, HTTP_MIN_TIMEOUT)
+    return min(HTTP_CONNECT_TIMEOUT, left), left
@@ -16,12 +16,15 @@ ERROR_MESSAGES = {
     10034: 'Internal error',
     10035: 'Controller not found',
     10036: 'API not found',
+    10037: 'Request deadline exceeded',
+    10038: 'Dependency unavailable',
 
     #2xxxx Authetication Errors
     20010: 'Authentication required',
 
     #hack HTTP Errors 90000~99999
     90405: '405 Method not allowed',
+    90503: '503 Service Unavailable',
 }
 
 class CustomError(BaseException):
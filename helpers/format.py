@@ -6,9 +6,15 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 #format your objects before sending responses
+#formatters take the optional meta['fields'] projection and drop everything else
+
+def project(obj, fields=None):
+    if not fields or obj is None:
+        return obj
+    return dict((k, v) for k, v in obj.iteritems() if k in fields)
 
 #sample
-def format_account(account):
-    return {
+def format_account(account, fields=None):
+    return project({
         'id': account['id'],
-    }
+    }, fields)
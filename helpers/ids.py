@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import time
+import fcntl
+import socket
+import threading
+
+import config
+
+#snowflake style 63 bit ids: milliseconds since ID_EPOCH | worker id | per millisecond sequence
+#with config.ID_WORKER set it numbers the host: each process then locks a free slot of ID_SLOT_PATH
+#(an fcntl byte lock, dropped by the kernel when the process dies) and uses ID_WORKER * ID_HOST_SLOTS + slot.
+#otherwise a process leases a free worker id in redis after fork and refreshes the lease while it hands
+#out ids. the sequence never waits for the clock: when a millisecond is used up (or the clock goes back)
+#ids continue on the next logical millisecond.
+#ids keep growing with time and sort after the ones generate_long_id used to return.
+
+ID_EPOCH = getattr(config, 'ID_EPOCH', 1262304000000) #2010-01-01 UTC, ms
+ID_WORKER = getattr(config, 'ID_WORKER', None)
+ID_LEASE = getattr(config, 'ID_LEASE', 600) #seconds
+ID_HOST_SLOTS = getattr(config, 'ID_HOST_SLOTS', 32) #processes per host with a fixed ID_WORKER
+ID_SLOT_PATH = getattr(config, 'ID_SLOT_PATH', '/tmp/pycrabapi.ids')
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKERS = 1 << WORKER_BITS
+MAX_SEQUENCE = 1 << SEQUENCE_BITS
+LEASE_KEY = 'ids:worker:%d'
+
+class IdGenerator(object):
+
+    def __init__(self, worker=None, slot_path=ID_SLOT_PATH):
+        if worker is not None and not 0 <= worker < MAX_WORKERS / ID_HOST_SLOTS:
+            raise ValueError('ID_WORKER must be in [0, %d)' % (MAX_WORKERS / ID_HOST_SLOTS))
+        self.fixed_worker = worker
+        self.slot_path = slot_path
+        self.slot_fd = None
+        self.worker = None
+        self.pid = None
+        self.lease_until = 0
+        self.last = 0 #last logical millisecond handed out
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def _lease(self, now):
+        from singletons import rds, REDIS_ERRORS
+        owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        try:
+            if self.worker is not None and rds.get(LEASE_KEY % self.worker) == owner:
+                rds.set(LEASE_KEY % self.worker, owner, ex=ID_LEASE)
+                self.lease_until = now + ID_LEASE / 2
+                return
+            start = rds.incr('ids:worker:next')
+            for n in xrange(start, start + MAX_WORKERS):
+                if rds.set(LEASE_KEY % (n % MAX_WORKERS), owner, ex=ID_LEASE, nx=True):
+                    self.worker = n % MAX_WORKERS
+                    self.lease_until = now + ID_LEASE / 2
+                    return
+        except REDIS_ERRORS:
+            if self.worker is not None:
+                #keep the id we hold and retry the refresh shortly
+                self.lease_until = now + 5
+                return
+            raise
+        raise RuntimeError('no free id worker slot')
+
+    def _claim_slot(self):
+        if self.slot_fd is not None:
+            #inherited from the parent, its lock stays with the parent
+            os.close(self.slot_fd)
+            self.slot_fd = None
+        fd = os.open(self.slot_path, os.O_RDWR | os.O_CREAT, 0644)
+        for slot in xrange(ID_HOST_SLOTS):
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot, 0)
+            except IOError:
+                continue
+            self.slot_fd = fd
+            return slot
+        os.close(fd)
+        raise RuntimeError('more than %d processes use ID_WORKER %d on this host' % (ID_HOST_SLOTS, self.fixed_worker))
+
+    def _check_worker(self, now):
+        if self.pid != os.getpid():
+            #forked: the parent's worker id and sequence belong to the parent
+            self.pid = os.getpid()
+            self.last = 0
+            self.sequence = 0
+            if self.fixed_worker is None:
+                self.worker = None
+                self.lease_until = 0
+            else:
+                self.worker = self.fixed_worker * ID_HOST_SLOTS + self._claim_slot()
+        if self.fixed_worker is None and now >= self.lease_until:
+            self._lease(now)
+
+    def next_ids(self, n):
+        #n consecutive ids, reserved under one lock
+        with self.lock:
+            now = time.time()
+            self._check_worker(now)
+            ms = int(now * 1000) - ID_EPOCH
+            if ms > self.last:
+                self.last = ms
+                self.sequence = 0
+            res = []
+            while n > 0:
+                if self.sequence >= MAX_SEQUENCE:
+                    self.last += 1
+                    self.sequence = 0
+                take = min(n, MAX_SEQUENCE - self.sequence)
+                base = (self.last << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker << SEQUENCE_BITS)
+                res.extend(xrange(base + self.sequence, base + self.sequence + take))
+                self.sequence += take
+                n -= take
+            return res
+
+    def next_id(self):
+        return self.next_ids(1)[0]
+
+def parse(id):
+    return {
+        'time': ((id >> (WORKER_BITS + SEQUENCE_BITS)) + ID_EPOCH) / 1000.0,
+        'worker': (id >> SEQUENCE_BITS) & (MAX_WORKERS - 1),
+        'sequence': id & (MAX_SEQUENCE - 1),
+    }
+
+generator = IdGenerator(ID_WORKER)
+next_id = generator.next_id
+next_ids = generator.next_ids
+
+if __name__ == '__main__':
+    import tempfile
+    import timeit
+    from multiprocessing import Process, Queue
+
+    def produce(make, q):
+        g = make()
+        res = []
+        for i in xrange(200):
+            res.extend(g.next_ids(500))
+            res.append(g.next_id())
+        q.put(res)
+
+    def check_unique(name, make, n=8):
+        q = Queue()
+        procs = [Process(target=produce, args=(make, q)) for i in range(n)]
+        for p in procs:
+            p.start()
+        results = [q.get() for p in procs]
+        for p in procs:
+            p.join()
+        for res in results:
+            assert res == sorted(res)
+        total = sum(len(res) for res in results)
+        assert len(set().union(*results)) == total
+        print '%-32s %d ids from %d processes, no duplicates' % (name, total, n)
+
+    slot_path = tempfile.mktemp()
+    #one generator created before fork, as in a preforking uwsgi master
+    shared = IdGenerator(3, slot_path)
+    shared.next_id()
+    check_unique('same ID_WORKER, forked', lambda: shared)
+    check_unique('same ID_WORKER, per process', lambda: IdGenerator(3, slot_path))
+    try:
+        from singletons import rds
+        rds.ping()
+    except Exception, e:
+        print 'redis lease path skipped, redis not available:', e
+    else:
+        check_unique('redis leases', IdGenerator)
+
+    g = IdGenerator(1, slot_path)
+    n = 200000
+    print 'next_id          %.2fM ids/s' % (n / min(timeit.repeat(g.next_id, number=n, repeat=3)) / 1e6)
+    print 'next_ids(1000)   %.2fM ids/s' % (n / min(timeit.repeat(lambda: g.next_ids(1000), number=n / 1000, repeat=3)) / 1e6)
+    print 'generate_long_id %.2fM ids/s (old)' % (2000 / min(timeit.repeat(
+        lambda: (time.sleep(0.000001), int(time.time() * 1000000) * 100), number=2000, repeat=3)) / 1e6)
+    os.remove(slot_path)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import importlib
+
+#lazy module proxies, heavy optional dependencies are imported on first attribute access
+#instead of when japi starts, workers that never send mail or encrypt never pay for them
+
+class LazyModule(object):
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = self.__dict__['_module'] is None and 'not loaded' or 'loaded'
+        return '<lazy module %r (%s)>' % (self.__dict__['_name'], state)
+
+if __name__ == '__main__':
+    #startup budget: import time of each module in a fresh interpreter (python 2 has no -X importtime)
+    import os
+    import subprocess
+
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    modules = sys.argv[1:] or ['log', 'singletons', 'helpers.util', 'helpers.mail', 'japi',
+                               'requests', 'jinja2', 'Crypto.Cipher.AES']
+    for name in modules:
+        code = 'import time; t = time.time(); import %s; print "%%.1f" %% ((time.time() - t) * 1000)' % name
+        p = subprocess.Popen([sys.executable, '-c', code], cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        print '%-20s %s' % (name, p.returncode and 'failed: ' + err.strip().split('\n')[-1] or out.strip() + 'ms')
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import re
+import mmap
+import math
+import time
+import fcntl
+import struct
+import zlib
+
+import config
+
+#adaptive concurrency limit shared by all uwsgi workers on a host
+#in-flight requests live in one slot per worker in a small mmap'd file, so a dead worker can't leak them.
+#a prefork host never has more requests in flight than workers, so the limit applies to the demand:
+#requests in flight plus the ones waiting in the uwsgi listen queue.
+#the limit follows a gradient: it shrinks when requests get slower than their route's usual latency
+#(a long running mean per route kept in the same file, so normal variance is not overload) and grows
+#by sqrt(limit) while they hold and at least half of it is used. it never drops below the worker count,
+#so critical requests are only shed once a queue builds up. lower priority routes get a smaller share
+#of the limit and are shed first.
+#when nginx sets X-Request-Start, time spent queueing in front of the workers sheds requests too:
+#critical ones past LIMITER_QUEUE_TARGET, lower priorities earlier.
+
+LIMITER_PATH = getattr(config, 'LIMITER_PATH', '/tmp/pycrabapi.limiter')
+LIMITER_MIN = getattr(config, 'LIMITER_MIN', 2)
+LIMITER_MAX = getattr(config, 'LIMITER_MAX', 200)
+LIMITER_INITIAL = getattr(config, 'LIMITER_INITIAL', 20)
+LIMITER_TOLERANCE = getattr(config, 'LIMITER_TOLERANCE', 2.0) #latency may grow this much before the limit shrinks
+LIMITER_QUEUE_TARGET = getattr(config, 'LIMITER_QUEUE_TARGET', 0.1) #seconds
+LIMITER_WINDOW = getattr(config, 'LIMITER_WINDOW', 60) #seconds a route's usual latency is averaged over
+LIMITER_WARMUP = 20 #first requests of a route on the host, a plain mean that leaves the limit alone
+MAX_WORKERS = 256
+STALE_AFTER = 60
+MAX_ROUTES = 1024
+
+#share of the limit a priority may use
+PRIORITIES = {
+    'critical': 1.0,
+    'normal': 0.8,
+    'low': 0.5,
+}
+
+_HEADER = struct.Struct('ddd') #limit, smoothed slowdown (latency / route usual latency), unused
+_ROUTE_ID_RE = re.compile(r'\d+')
+_SLOT = struct.Struct('d') #request start time, 0 when idle
+_ROUTE = struct.Struct('ddd') #usual latency, samples, last update. routes hash into MAX_ROUTES entries
+_ROUTES_OFFSET = _HEADER.size + _SLOT.size * MAX_WORKERS
+
+def route_priority(module, method, uri):
+    #controllers declare PRIORITIES = {'GET': [('^regex$', 'low'), ...]} next to their route table
+    compiled = getattr(module, '_compiled_priorities', None)
+    if compiled is None:
+        compiled = {}
+        for m, rules in getattr(module, 'PRIORITIES', {}).iteritems():
+            compiled[m] = [(re.compile(r), p) for r, p in rules]
+        module._compiled_priorities = compiled
+    for r, priority in compiled.get(method, ()):
+        if r.match(uri):
+            return priority
+    return 'normal'
+
+def queue_time(environ):
+    #nginx: proxy_set_header X-Request-Start "t=${msec}";
+    start = environ.get('HTTP_X_REQUEST_START', '').lstrip('t=')
+    try:
+        start = float(start)
+    except ValueError:
+        return 0.0
+    while start > 1e11: #ms or us
+        start /= 1000.0
+    return max(0.0, time.time() - start)
+
+def route_key(module, method, uri):
+    #ids in the uri would make every record its own route
+    return '%s %s %s' % (module.__name__, method, _ROUTE_ID_RE.sub('#', uri))
+
+def _worker_id():
+    try:
+        import uwsgi
+        return uwsgi.worker_id() % MAX_WORKERS
+    except ImportError:
+        return os.getpid() % MAX_WORKERS
+
+def _worker_count():
+    try:
+        import uwsgi
+        return uwsgi.numproc
+    except (ImportError, AttributeError):
+        return 1
+
+def _listen_queue():
+    #requests accepted by the kernel that no worker has picked up yet
+    try:
+        import uwsgi
+        return uwsgi.listen_queue()
+    except (ImportError, AttributeError):
+        return 0
+
+class Limiter(object):
+
+    def __init__(self, path=LIMITER_PATH):
+        self.path = path
+        self.map = None
+        self.fd = None
+        self.pid = None
+        self.depth = 0
+        self.shed = {}
+        self.route = None
+        self.demand = 0
+        self.backlog = _listen_queue
+
+    def _open(self):
+        #opened lazily so every forked worker gets its own fd
+        if self.map is None or self.pid != os.getpid():
+            size = _ROUTES_OFFSET + _ROUTE.size * MAX_ROUTES
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+            if os.fstat(self.fd).st_size < size:
+                os.ftruncate(self.fd, size)
+            self.map = mmap.mmap(self.fd, size)
+            self.pid = os.getpid()
+            self.slot = _HEADER.size + _SLOT.size * _worker_id()
+            self.floor = min(LIMITER_MAX, max(LIMITER_MIN, _worker_count()))
+
+    def _lock(self):
+        self._open()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _inflight(self, now):
+        n = 0
+        for offset in xrange(_HEADER.size, _ROUTES_OFFSET, _SLOT.size):
+            started = _SLOT.unpack_from(self.map, offset)[0]
+            if started and now - started < STALE_AFTER:
+                n += 1
+        return n
+
+    def acquire(self, priority='normal', queued=0.0, route=None):
+        #nested calls (multiapi) run inside the slot of the outer request
+        if self.depth:
+            self.depth += 1
+            return True
+        now = time.time()
+        self._lock()
+        try:
+            limit, slowdown, unused = _HEADER.unpack_from(self.map, 0)
+            if not limit:
+                limit = max(LIMITER_INITIAL, self.floor)
+                _HEADER.pack_into(self.map, 0, limit, 0.0, 0.0)
+            share = PRIORITIES.get(priority, PRIORITIES['normal'])
+            demand = self._inflight(now) + self.backlog()
+            if demand >= max(limit * share, 1) or queued > LIMITER_QUEUE_TARGET * share:
+                self.shed[priority] = self.shed.get(priority, 0) + 1
+                return False
+            self.demand = demand + 1
+            _SLOT.pack_into(self.map, self.slot, now)
+        finally:
+            self._unlock()
+        self.depth = 1
+        self.route = route
+        return True
+
+    def _slowdown(self, cost, now):
+        #under the lock. the usual latency is a plain mean over the first requests, then a moving average
+        #over about LIMITER_WINDOW seconds: a burst of overload barely moves it, a permanently slower
+        #route is relearned within a few windows
+        offset = _ROUTES_OFFSET + _ROUTE.size * (zlib.crc32(str(self.route)) % MAX_ROUTES)
+        usual, samples, updated = _ROUTE.unpack_from(self.map, offset)
+        samples += 1
+        if samples <= LIMITER_WARMUP:
+            weight = 1.0 / samples
+        else:
+            weight = min(1.0, (now - updated) / LIMITER_WINDOW)
+        _ROUTE.pack_into(self.map, offset, usual + (cost - usual) * weight, samples, now)
+        if samples <= LIMITER_WARMUP:
+            #no opinion yet, growing the limit now would teach the route overload as its usual latency
+            return None
+        return usual and cost / usual or 1.0
+
+    def release(self, cost):
+        self.depth -= 1
+        if self.depth:
+            return
+        self._lock()
+        try:
+            _SLOT.pack_into(self.map, self.slot, 0.0)
+            ratio = self._slowdown(cost, time.time())
+            if ratio is None:
+                return
+            limit, slowdown, unused = _HEADER.unpack_from(self.map, 0)
+            slowdown = slowdown and slowdown * 0.9 + ratio * 0.1 or ratio
+            gradient = max(0.5, min(1.0, LIMITER_TOLERANCE / slowdown))
+            #only a limit that is being used grows, an idle host keeps its limit instead of drifting to the max
+            new_limit = limit * gradient + (self.demand * 2 >= limit and math.sqrt(limit) or 0.0)
+            limit = min(LIMITER_MAX, max(self.floor, limit * 0.8 + new_limit * 0.2))
+            _HEADER.pack_into(self.map, 0, limit, slowdown, 0.0)
+        finally:
+            self._unlock()
+
+    def get_stats(self):
+        self._lock()
+        try:
+            limit, slowdown, unused = _HEADER.unpack_from(self.map, 0)
+            inflight = self._inflight(time.time())
+            routes = sum(1 for offset in xrange(_ROUTES_OFFSET, _ROUTES_OFFSET + _ROUTE.size * MAX_ROUTES, _ROUTE.size)
+                         if _ROUTE.unpack_from(self.map, offset)[1])
+        finally:
+            self._unlock()
+        return {
+            'limit': limit,
+            'floor': self.floor,
+            'inflight': inflight,
+            'queue': self.backlog(),
+            'slowdown': slowdown,
+            'routes': routes,
+            'shed': dict(self.shed),
+        }
+
+limiter = Limiter()
+
+if __name__ == '__main__':
+    #2x overload: 16 clients against a backend whose latency degrades past 8 concurrent requests
+    import random
+    import tempfile
+    from multiprocessing import Process, Queue
+
+    CAPACITY = 8
+    BASE = 0.01
+    path = tempfile.mktemp()
+
+    def backend(inflight):
+        time.sleep(BASE * max(1.0, float(inflight) / CAPACITY) ** 2)
+
+    def client(i, use_limiter, q):
+        l = Limiter(path)
+        l._open()
+        l.slot = _HEADER.size + _SLOT.size * i
+        latencies = []
+        shed = 0
+        end = time.time() + 5
+        while time.time() < end:
+            start = time.time()
+            priority = random.random() < 0.5 and 'low' or 'normal'
+            if not l.acquire(priority):
+                shed += 1
+                time.sleep(BASE)
+                continue
+            l._lock()
+            inflight = l._inflight(time.time())
+            l._unlock()
+            backend(inflight)
+            cost = time.time() - start
+            l.release(cost)
+            latencies.append(cost)
+        q.put((latencies, shed))
+
+    for use_limiter in (False, True):
+        if os.path.exists(path):
+            os.remove(path)
+        #without the limiter the limit is pinned above the number of clients
+        LIMITER_INITIAL = use_limiter and CAPACITY / 2 or 1000
+        LIMITER_MIN = use_limiter and 2 or 1000
+        LIMITER_MAX = use_limiter and 200 or 1000
+        q = Queue()
+        procs = [Process(target=client, args=(i, use_limiter, q)) for i in range(2 * CAPACITY)]
+        for p in procs:
+            p.start()
+        results = [q.get() for p in procs]
+        for p in procs:
+            p.join()
+        latencies = sorted(sum((r[0] for r in results), []))
+        shed = sum(r[1] for r in results)
+        print '%-10s served %5d  shed %5d  p50 %.1fms  p99 %.1fms' % (
+            use_limiter and 'limiter' or 'no limit', len(latencies), shed,
+            latencies[len(latencies) / 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000)
+    os.remove(path)
+
+    #mixed routes, strictly sequential: alternating 1ms and 20ms routes is not overload
+    LIMITER_INITIAL, LIMITER_MIN, LIMITER_MAX = 20, 2, 200
+    l = Limiter(path)
+    for i in xrange(2000):
+        l.acquire('normal', route=i % 2 and 'slow' or 'fast')
+        l.release(i % 2 and 0.020 or 0.001)
+    print 'mixed routes, sequential: limit %.1f' % l.get_stats()['limit']
+    assert l.get_stats()['limit'] >= LIMITER_INITIAL
+    os.remove(path)
+
+    #one route whose latency varies between 1ms and 10ms is not overload either
+    l = Limiter(path)
+    for i in xrange(2000):
+        l.acquire('normal', route='jittery')
+        l.release(i % 2 and 0.010 or 0.001)
+    print 'one jittery route, sequential: limit %.1f' % l.get_stats()['limit']
+    assert l.get_stats()['limit'] >= LIMITER_INITIAL
+
+    #the same route getting 10x slower for good is, until it is relearned
+    for i in xrange(100):
+        l.acquire('normal', route='jittery')
+        l.release(0.055)
+    print 'sustained slowdown: limit %.1f' % l.get_stats()['limit']
+    assert l.get_stats()['limit'] < LIMITER_MAX / 4
+
+    #in flight never exceeds the workers, a queue in front of them gets even critical requests shed
+    l.backlog = lambda: 100
+    assert not l.acquire('critical', route='jittery')
+    l.backlog = lambda: 0
+    assert l.acquire('critical', route='jittery')
+    l.release(0.001)
+    #so does time spent queueing in front of them, lower priorities first
+    assert not l.acquire('low', LIMITER_QUEUE_TARGET * 0.6, route='jittery')
+    assert l.acquire('critical', LIMITER_QUEUE_TARGET * 0.6, route='jittery')
+    l.release(0.001)
+    os.remove(path)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+#request scoped batch loading, kills N+1 queries in formatters
+#a DAO declares a batch form (ids -> {id: row}) and wraps it in a Loader,
+#prime() the ids of a list once, then per item load() calls are served from the request cache
+
+_scopes = []
+
+def open_scope():
+    scope = {'loaders': {}, 'batches': 0, 'keys': 0, 'hits': 0}
+    _scopes.append(scope)
+    return scope
+
+def close_scope():
+    if _scopes:
+        return _scopes.pop()
+
+def current_scope():
+    return _scopes and _scopes[-1] or None
+
+def _hashable(value):
+    #extra args like meta['fields'] arrive as lists
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.iteritems()))
+    return value
+
+class Loader(object):
+
+    def __init__(self, batch_func, key_func=str):
+        self.batch_func = batch_func
+        self.key_func = key_func
+
+    def load_many(self, keys, *extra):
+        scope = current_scope()
+        if scope is None:
+            cache = {}
+        else:
+            cache = scope['loaders'].setdefault(self, {})
+        keys = [self.key_func(k) for k in keys]
+        tag = _hashable(extra)
+        missing = []
+        for k in keys:
+            if (k, tag) not in cache and k not in missing:
+                missing.append(k)
+        if missing:
+            rows = self.batch_func(missing, *extra)
+            rows = dict((self.key_func(k), v) for k, v in rows.iteritems())
+            for k in missing:
+                cache[(k, tag)] = rows.get(k)
+        if scope is not None:
+            scope['batches'] += missing and 1 or 0
+            scope['keys'] += len(missing)
+            scope['hits'] += len(keys) - len(missing)
+        return [cache[(k, tag)] for k in keys]
+
+    def load(self, key, *extra):
+        return self.load_many([key], *extra)[0]
+
+    def prime(self, keys, *extra):
+        self.load_many(keys, *extra)
+
+    def clear(self):
+        scope = current_scope()
+        if scope is not None:
+            scope['loaders'].pop(self, None)
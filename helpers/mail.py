@@ -1,16 +1,39 @@
 # -*- coding: utf-8 -*-
 
-import requests
-from jinja2 import Template
+import os
 import json
-from simpleflake import simpleflake
+import time
+import itertools
 
-from singletons import rds
+from singletons import rds, REDIS_ERRORS
+from helpers import deadline
+from helpers.ids import next_ids
+from helpers.breaker import CircuitBreaker, CircuitOpen
+from helpers.lazy import LazyModule
 import config
 
+requests = LazyModule('requests')
+jinja2 = LazyModule('jinja2')
+
+MAIL_SPOOL_PATH = getattr(config, 'MAIL_SPOOL_PATH', config.LOG_PATH + 'mail_spool/')
+
+mail_breaker = CircuitBreaker('mail', errors=(IOError, )) #requests.RequestException is an IOError
+
+_templates = {}
+_spool_seq = itertools.count()
+
+def get_template(template_name):
+    template = _templates.get(template_name)
+    if template is None:
+        template = _templates[template_name] = jinja2.Template(open('mail/' + template_name).read().decode('utf-8'))
+    return template
+
+def load_templates():
+    for template_name in os.listdir('mail'):
+        get_template(template_name)
+
 def get_mail_body(template_name, *args, **kwargs):
-    body_html_template = Template(open('mail/' + template_name).read().decode('utf-8'))
-    body_html = body_html_template.render(*args, **kwargs)
+    body_html = get_template(template_name).render(*args, **kwargs)
     return body_html
 
 def mailgun_send(to, body, subject, attachments=None, campaign_id=None):
@@ -31,8 +54,8 @@ def mailgun_send(to, body, subject, attachments=None, campaign_id=None):
     }
     if len(to) > 1:
         rv = {}
-        for recipient in to:
-            rv[recipient] = {'unique_id': simpleflake()}
+        for recipient, unique_id in zip(to, next_ids(len(to))):
+            rv[recipient] = {'unique_id': unique_id}
         params['data']['recipient-variables'] = json.dumps(rv)
     if campaign_id:
         params['data']['o:campaign'] = campaign_id
@@ -49,10 +72,47 @@ def mailgun_send(to, body, subject, attachments=None, campaign_id=None):
         print '========== mock send mail =========='
         print params
         print '===================================='
-    rlt = requests.post(config.MAILGUN_PATH, **params)
+    rlt = requests.post(config.MAILGUN_PATH, timeout=deadline.http_timeout(), **params)
     for attf in attfs:
         attf.close()
     return rlt
 
-def send(to, body, subject):
-    return mailgun_send(to, body, subject)
+def _checked_send(to, body, subject):
+    rlt = mailgun_send(to, body, subject)
+    if rlt.status_code >= 500:
+        rlt.raise_for_status()
+    return rlt
+
+def spool(to, body, subject):
+    if not os.path.isdir(MAIL_SPOOL_PATH):
+        os.makedirs(MAIL_SPOOL_PATH)
+    #named without the id service, spooling is the fallback for when redis may be down too
+    name = '%d.%d.%d.json' % (time.time() * 1000000, os.getpid(), next(_spool_seq))
+    with open(os.path.join(MAIL_SPOOL_PATH, name), 'wb') as f:
+        json.dump({'to': to, 'body': body, 'subject': subject}, f)
+
+def flush_spool():
+    #resend spooled mail, run it from cron or a uwsgi timer once the mail breaker has closed
+    if not os.path.isdir(MAIL_SPOOL_PATH):
+        return 0
+    sent = 0
+    for name in sorted(os.listdir(MAIL_SPOOL_PATH)):
+        path = os.path.join(MAIL_SPOOL_PATH, name)
+        with open(path, 'rb') as f:
+            mail = json.load(f)
+        try:
+            mail_breaker.call(_checked_send, mail['to'], mail['body'], mail['subject'])
+        except (CircuitOpen, requests.RequestException):
+            break
+        os.remove(path)
+        sent += 1
+    return sent
+
+def send(to, body, subject, spool_on_failure=False):
+    try:
+        return mail_breaker.call(_checked_send, to, body, subject)
+    except (CircuitOpen, requests.RequestException) + REDIS_ERRORS:
+        #redis errors: recipient ids need a worker id lease
+        if not spool_on_failure:
+            raise
+        spool(to, body, subject)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+
+from helpers.error import error
+from helpers.util import base64_url_encode, base64_url_decode, realize
+from singletons import mysql_conn, COLUMN_NAME_RE
+
+#keyset (seek) pagination, page N costs the same as page 1
+#order is a list of (column, 'asc'|'desc') ending with a unique column, e.g. [('created_at', 'desc'), ('id', 'desc')]
+#the cursor token is the sort key of the last row of the previous page
+
+def encode_cursor(row, order):
+    return base64_url_encode(json.dumps(realize([row[c] for c, _ in order])))
+
+def decode_cursor(cursor, order):
+    try:
+        values = json.loads(base64_url_decode(cursor))
+    except (TypeError, ValueError):
+        values = None
+    if not isinstance(values, list) or len(values) != len(order):
+        error(10010, {'cursor': cursor})
+    return values
+
+def _seek(order, values):
+    #(a > x) or (a = x and b > y) or ..., written out so mixed directions work
+    ors = []
+    for i, (column, direction) in enumerate(order):
+        ands = ['`%s` = %%s' % c for c, _ in order[:i]]
+        ands.append('`%s` %s %%s' % (column, direction == 'desc' and '<' or '>'))
+        ors.append('(' + ' and '.join(ands) + ')')
+    params = []
+    for i in range(len(order)):
+        params.extend(values[:i + 1])
+    #the leading range on the first column lets MySQL use the index
+    first, direction = order[0]
+    return '`%s` %s %%s and (%s)' % (first, direction == 'desc' and '<=' or '>=', ' or '.join(ors)), [values[0]] + params
+
+def fetch_page(select, where, params, order, cursor=None, limit=20, compact=False):
+    for column, direction in order:
+        if not COLUMN_NAME_RE.match(column) or direction not in ('asc', 'desc'):
+            raise ValueError('invalid sort key: %r' % ((column, direction), ))
+    conditions = where and ['(' + where + ')'] or []
+    params = list(params or ())
+    if cursor:
+        seek, seek_params = _seek(order, decode_cursor(cursor, order))
+        conditions.append(seek)
+        params.extend(seek_params)
+    query = select
+    if conditions:
+        query += ' where ' + ' and '.join(conditions)
+    query += ' order by ' + ', '.join('`%s` %s' % (c, d) for c, d in order) + ' limit %s'
+    params.append(limit + 1)
+    rows = mysql_conn.fetch_all(query, tuple(params), compact)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1], order)
+    return rows, next_cursor
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import re
+import time
+import json
+import random
+
+import config
+from log import debug_log, slow_log
+
+#query instrumentation for singletons.MySQL
+#queries are grouped by fingerprint (literals and placeholders folded to ?),
+#slow ones are sampled into slow.log together with their EXPLAIN
+
+SLOW_QUERY_MS = getattr(config, 'MYSQL_SLOW_QUERY_MS', 200)
+SLOW_QUERY_SAMPLE = getattr(config, 'MYSQL_SLOW_QUERY_SAMPLE', 1.0)
+EXPLAIN_INTERVAL = getattr(config, 'MYSQL_EXPLAIN_INTERVAL', 60)
+QUERY_BUDGET = getattr(config, 'MYSQL_QUERY_BUDGET', 50)
+HISTOGRAM_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, float('inf')) #ms
+MAX_FINGERPRINTS = 1000
+
+_STRING_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER_RE = re.compile(r'%s|%\(\w+\)s')
+_IN_LIST_RE = re.compile(r'\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.I)
+_VALUES_LIST_RE = re.compile(r'\bvalues\s*(\([?,\s]*\))(?:\s*,\s*\([?,\s]*\))+', re.I)
+_SPACE_RE = re.compile(r'\s+')
+MAX_QUERY_LOG = 1000
+
+_fingerprints = {}
+
+def fingerprint(query):
+    fp = _fingerprints.get(query)
+    if fp is None:
+        fp = _STRING_RE.sub('?', query)
+        fp = _PLACEHOLDER_RE.sub('?', fp)
+        fp = _NUMBER_RE.sub('?', fp)
+        fp = _IN_LIST_RE.sub('in (?+)', fp)
+        fp = _VALUES_LIST_RE.sub(r'values \1+', fp)
+        fp = _SPACE_RE.sub(' ', fp).strip().lower()
+        if len(_fingerprints) < MAX_FINGERPRINTS:
+            _fingerprints[query] = fp
+    return fp
+
+class QueryLog(object):
+
+    def __init__(self):
+        self.statements = {}
+        self.explained = {}
+        self.request = None
+
+    def record(self, query, params, cost, explain=None):
+        fp = fingerprint(query)
+        ms = cost * 1000
+        s = self.statements.get(fp)
+        if s is None and len(self.statements) >= MAX_FINGERPRINTS:
+            fp = 'other'
+            s = self.statements.get(fp)
+        if s is None:
+            s = self.statements[fp] = {'count': 0, 'time': 0.0, 'max': 0.0, 'histogram': [0] * len(HISTOGRAM_BUCKETS)}
+        s['count'] += 1
+        s['time'] += ms
+        s['max'] = max(s['max'], ms)
+        for i, bucket in enumerate(HISTOGRAM_BUCKETS):
+            if ms <= bucket:
+                s['histogram'][i] += 1
+                break
+
+        if self.request is not None:
+            r = self.request
+            r['count'] += 1
+            r['time'] += ms
+            r['statements'][fp] = r['statements'].get(fp, 0.0) + ms
+            if r['count'] == QUERY_BUDGET + 1:
+                debug_log.warn('query budget exceeded\t%s\t%d queries' % (r['path'], r['count']))
+
+        if ms >= SLOW_QUERY_MS and random.random() < SLOW_QUERY_SAMPLE:
+            self.log_slow(fp, query, params, ms, explain)
+
+    def log_slow(self, fp, query, params, ms, explain):
+        plan = None
+        now = time.time()
+        #one EXPLAIN per fingerprint per interval keeps the overhead bounded
+        if explain and fp.startswith('select') and now - self.explained.get(fp, 0) > EXPLAIN_INTERVAL:
+            self.explained[fp] = now
+            try:
+                plan = explain(query, params)
+            except Exception, e:
+                plan = str(e)
+        slow_log.info('%.1f\t%s\t%s\t%s\t%s' % (
+            ms,
+            fp,
+            query[:MAX_QUERY_LOG],
+            repr(params)[:config.LOG_LENGTH],
+            json.dumps(plan, default=str))
+        )
+
+    def begin_request(self, path):
+        self.request = {'path': path, 'count': 0, 'time': 0.0, 'statements': {}}
+
+    def end_request(self):
+        r = self.request
+        self.request = None
+        if r is None or not r['count']:
+            return r
+        top = sorted(r['statements'].iteritems(), key=lambda x: -x[1])[:3]
+        debug_log.info('%s\t%d queries\t%.1fms\t%s' % (
+            r['path'],
+            r['count'],
+            r['time'],
+            ' | '.join('%.1fms %s' % (ms, fp) for fp, ms in top))
+        )
+        return r
+
+    def stats(self):
+        return dict((fp, dict(s)) for fp, s in self.statements.iteritems())
+
+query_log = QueryLog()
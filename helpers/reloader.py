@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import imp
+import time
+import threading
+
+import config
+
+#opt in controller hot reload: HOT_RELOAD = True in config
+#controller sources are polled by mtime between requests, at most every HOT_RELOAD_INTERVAL seconds.
+#a changed controller is executed into a fresh module object and swapped in only once it has loaded
+#and compiled, so requests in flight keep the old module and a broken file keeps serving the old one.
+#db connections, caches and everything outside the controller module stay as they are.
+
+HOT_RELOAD = getattr(config, 'HOT_RELOAD', False)
+HOT_RELOAD_INTERVAL = getattr(config, 'HOT_RELOAD_INTERVAL', 1.0)
+
+_sources = {} #name -> [path, mtime]
+_lock = threading.Lock()
+_state = {'checked': 0.0}
+_stats = {'reloads': 0, 'failures': 0, 'last': None, 'last_ms': 0.0, 'max_ms': 0.0}
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def track(name, path):
+    if path.endswith('.pyc') or path.endswith('.pyo'):
+        path = path[:-1]
+    _sources[name] = [path, _mtime(path)]
+
+def load(name, path):
+    m = imp.new_module(name)
+    m.__file__ = path
+    with open(path) as f:
+        code = compile(f.read(), path, 'exec')
+    exec code in m.__dict__
+    return m
+
+def reload_changed(modules, prepare, log=None):
+    #modules is the name -> module registry, prepare(m) compiles routes and rules before the swap
+    now = time.time()
+    if now - _state['checked'] < HOT_RELOAD_INTERVAL or not _lock.acquire(False):
+        return
+    try:
+        _state['checked'] = now
+        for name, source in _sources.items():
+            mtime = _mtime(source[0])
+            if mtime is None or mtime == source[1]:
+                continue
+            source[1] = mtime
+            start = time.time()
+            try:
+                m = load(name, source[0])
+                prepare(m)
+            except Exception, e:
+                _stats['failures'] += 1
+                if log:
+                    log.error('reload %s failed, keeping the loaded version: %r' % (name, e))
+                continue
+            modules[name] = sys.modules[name] = m
+            cost = (time.time() - start) * 1000
+            _stats['reloads'] += 1
+            _stats['last'] = name
+            _stats['last_ms'] = cost
+            _stats['max_ms'] = max(_stats['max_ms'], cost)
+            if log:
+                log.info('reload\t%s\t%.1fms' % (name, cost))
+    finally:
+        _lock.release()
+
+def stats():
+    return dict(_stats, enabled=HOT_RELOAD, tracked=len(_sources))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import re
+import hashlib
+
+from helpers import cache
+from helpers.cache import MISS, loads
+from singletons import rds, REDIS_ERRORS
+
+#full response cache for GET routes, checked in japi.application before process_action
+#controllers declare RESPONSE_CACHE = {'GET': [('^regex$', {'ttl': 30, 'vary': ['auth'], 'tag': 'accounts'}), ...]}
+#next to their route table. entries hold the final encoded (and gzipped) body, headers and ETag.
+#the key always varies by path, args, Accept and Accept-Encoding; vary ['auth'] adds the account.
+#the cache is served before the handler runs, so without vary ['auth'] a rule only serves anonymous
+#callers: their body carries no account and a route behind @login never stores its 20010.
+#write paths purge a route's entries with purge(tag), which also clears the DAO cache tag of that name
+
+LOCAL_TTL = 5
+IGNORED_ARGS = ('ip', 'ua_ip_hash', 'REQUEST_METHOD')
+
+local = cache.make_local(4096, LOCAL_TTL)
+_stats = {}
+
+def lookup_rule(module, method, uri):
+    compiled = getattr(module, '_compiled_response_cache', None)
+    if compiled is None:
+        compiled = {}
+        for m, rules in getattr(module, 'RESPONSE_CACHE', {}).iteritems():
+            compiled[m] = [(re.compile(r), dict(rule, route=r)) for r, rule in rules]
+        module._compiled_response_cache = compiled
+    for r, rule in compiled.get(method, ()):
+        if r.match(uri):
+            return rule
+
+def applies(rule, me):
+    return not me or 'auth' in rule.get('vary', ())
+
+def make_key(path, args, me, use_gzip, use_msgpack, rule):
+    items = sorted((k, v) for k, v in args.iteritems() if k not in IGNORED_ARGS)
+    caller = me and (me['id'], bool(me.get('is_session_id'))) or None
+    digest = hashlib.md5(repr((path, items, caller, use_gzip, use_msgpack))).hexdigest()
+    return 'response:%s' % digest
+
+def _record(rule, field):
+    s = _stats.get(rule['route'])
+    if s is None:
+        s = _stats[rule['route']] = {'hit_local': 0, 'hit_redis': 0, 'miss': 0}
+    s[field] += 1
+
+def fetch(rule, key):
+    entry = local.get(key)
+    if entry is not MISS:
+        _record(rule, 'hit_local')
+        return entry
+    try:
+        data = rds.get(key)
+    except REDIS_ERRORS:
+        data = None
+    if data is not None:
+        entry = loads(data)
+        local.set(key, entry, min(LOCAL_TTL, rule['ttl']), rule.get('tag') and [rule['tag']] or ())
+        _record(rule, 'hit_redis')
+        return entry
+    _record(rule, 'miss')
+
+def store(rule, key, body, headers, etag):
+    entry = (body, headers, etag)
+    tags = rule.get('tag') and [rule['tag']] or []
+    local.set(key, entry, min(LOCAL_TTL, rule['ttl']), tags)
+    try:
+        cache.store(key, entry, rule['ttl'], tags)
+    except REDIS_ERRORS:
+        pass
+
+def purge(*tags):
+    cache.invalidate(*tags)
+
+def stats():
+    res = {}
+    for route, s in _stats.iteritems():
+        total = sum(s.values())
+        res[route] = dict(s, hit_ratio=total and float(s['hit_local'] + s['hit_redis']) / total or 0.0)
+    return res
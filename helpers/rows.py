@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+#compact result rows: one shared column header plus a tuple per row
+#instead of a dict with repeated key strings per row, row['col'] still works
+
+class Header(object):
+
+    __slots__ = ('names', 'index')
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+
+    def __getstate__(self):
+        return self.names
+
+    def __setstate__(self, names):
+        self.__init__(names)
+
+class Row(object):
+
+    __slots__ = ('header', 'values')
+
+    def __init__(self, header, values):
+        self.header = header
+        self.values = values
+
+    def __getitem__(self, key):
+        return self.values[self.header.index[key]]
+
+    def get(self, key, default=None):
+        i = self.header.index.get(key)
+        if i is None:
+            return default
+        return self.values[i]
+
+    def __contains__(self, key):
+        return key in self.header.index
+
+    def __iter__(self):
+        return iter(self.header.names)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __eq__(self, other):
+        return self.to_dict() == (other.to_dict() if isinstance(other, Row) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Row(%r)' % self.to_dict()
+
+    def __getstate__(self):
+        return self.header, self.values
+
+    def __setstate__(self, state):
+        self.header, self.values = state
+
+    def keys(self):
+        return list(self.header.names)
+
+    def iteritems(self):
+        return iter(zip(self.header.names, self.values))
+
+    def items(self):
+        return zip(self.header.names, self.values)
+
+    def to_dict(self):
+        return dict(zip(self.header.names, self.values))
+
+def make_rows(description, tuples):
+    header = Header(d[0] for d in description)
+    return [Row(header, values) for values in tuples]
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import datetime
+
+    names = ['id', 'name', 'email', 'balance', 'is_active', 'created_at']
+    n = 100000
+    now = datetime.datetime.now()
+    tuples = [(i, 'user_%d' % i, 'user_%d@mydomain.com' % i, 1234.56, 1, now) for i in xrange(n)]
+
+    start = time.time()
+    dicts = [dict(zip(names, t)) for t in tuples]
+    dict_time = time.time() - start
+    dict_size = sum(sys.getsizeof(d) for d in dicts)
+
+    start = time.time()
+    rows = make_rows([(name, ) for name in names], tuples)
+    row_time = time.time() - start
+    #the row keeps its cursor tuple alive, dict rows let theirs go
+    row_size = sum(sys.getsizeof(r) + sys.getsizeof(r.values) for r in rows)
+
+    assert rows[5]['email'] == dicts[5]['email'] and rows[5] == dicts[5]
+    print 'dict rows %6.1f MB  %.3fs' % (dict_size / 1048576.0, dict_time)
+    print 'compact   %6.1f MB  %.3fs' % (row_size / 1048576.0, row_time)
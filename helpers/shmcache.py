@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import hashlib
+
+import config
+from helpers.cache import MISS, dumps, loads
+
+#key/value store shared by all uwsgi workers on a host, a drop in for helpers.cache.LRUCache
+#fixed size mmap'd hash table: every key hashes to a bucket of WAYS fixed size slots, a full
+#bucket evicts with CLOCK (second chance on the ref bit). buckets are locked with fcntl byte
+#range locks, so workers only contend on the same bucket. values are pickled with their TTL.
+#tags are generation counters in the same file: invalidate(tag) bumps the counter and every
+#entry stored under the old generation reads as a miss in every worker.
+
+SHM_CACHE_PATH = getattr(config, 'SHM_CACHE_PATH', os.path.isdir('/dev/shm') and '/dev/shm/pycrabapi.cache' or '/tmp/pycrabapi.cache')
+SHM_CACHE_SLOTS = getattr(config, 'SHM_CACHE_SLOTS', 8192)
+SHM_CACHE_SLOT_SIZE = getattr(config, 'SHM_CACHE_SLOT_SIZE', 2048)
+WAYS = 8
+TAG_SLOTS = 4096
+MAGIC = 0x6a617069
+
+_FILE_HEADER = struct.Struct('<IIII') #magic, slots, slot size, tag slots
+_SLOT_HEADER = struct.Struct('<16sdBI') #key digest, expire at, ref bit, value length
+_TAG = struct.Struct('<Q')
+_BUCKET = struct.Struct('<Q')
+
+class SharedCache(object):
+
+    def __init__(self, path=SHM_CACHE_PATH, slots=SHM_CACHE_SLOTS, slot_size=SHM_CACHE_SLOT_SIZE, ttl=60):
+        self.path = path
+        self.ttl = ttl
+        self.slot_size = slot_size
+        self.buckets = max(1, slots // WAYS)
+        self.slots = self.buckets * WAYS
+        self.max_value = slot_size - _SLOT_HEADER.size
+        self.tags_offset = _FILE_HEADER.size
+        self.slots_offset = self.tags_offset + _TAG.size * TAG_SLOTS
+        self.size = self.slots_offset + self.slots * slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 0, 0)
+        try:
+            header = os.read(self.fd, _FILE_HEADER.size)
+            if (len(header) < _FILE_HEADER.size or
+                    _FILE_HEADER.unpack(header) != (MAGIC, self.slots, slot_size, TAG_SLOTS)):
+                #new file or different geometry, start empty
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.size)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, _FILE_HEADER.pack(MAGIC, self.slots, slot_size, TAG_SLOTS))
+            self.map = mmap.mmap(self.fd, self.size)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 0, 0)
+        self.stats = {'hit': 0, 'miss': 0, 'set': 0, 'evict': 0, 'too_big': 0}
+
+    def _bucket(self, digest):
+        return self.slots_offset + (_BUCKET.unpack(digest[:8])[0] % self.buckets) * WAYS * self.slot_size
+
+    def _lock(self, offset, length):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, length, offset, 0)
+
+    def _unlock(self, offset, length):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset, 0)
+
+    def _tag_offset(self, tag):
+        return self.tags_offset + (zlib.crc32(tag) & 0xffffffff) % TAG_SLOTS * _TAG.size
+
+    def _generation(self, offset):
+        return _TAG.unpack_from(self.map, offset)[0]
+
+    def get(self, key):
+        digest = hashlib.md5(key).digest()
+        bucket = self._bucket(digest)
+        length = WAYS * self.slot_size
+        data = None
+        self._lock(bucket, length)
+        try:
+            for off in xrange(bucket, bucket + length, self.slot_size):
+                d, expire_at, ref, size = _SLOT_HEADER.unpack_from(self.map, off)
+                if d == digest:
+                    if expire_at >= time.time():
+                        if not ref:
+                            _SLOT_HEADER.pack_into(self.map, off, d, expire_at, 1, size)
+                        start = off + _SLOT_HEADER.size
+                        data = self.map[start:start + size]
+                    break
+        finally:
+            self._unlock(bucket, length)
+        if data is None:
+            self.stats['miss'] += 1
+            return MISS
+        value, generations = loads(data)
+        for offset, generation in generations:
+            if self._generation(offset) != generation:
+                self.stats['miss'] += 1
+                return MISS
+        self.stats['hit'] += 1
+        return value
+
+    def set(self, key, value, ttl=None, tags=()):
+        generations = [(o, self._generation(o)) for o in (self._tag_offset(t) for t in tags)]
+        data = dumps((value, generations))
+        if len(data) > self.max_value:
+            self.stats['too_big'] += 1
+            return False
+        digest = hashlib.md5(key).digest()
+        bucket = self._bucket(digest)
+        length = WAYS * self.slot_size
+        now = time.time()
+        self._lock(bucket, length)
+        try:
+            target = None
+            free = None
+            for off in xrange(bucket, bucket + length, self.slot_size):
+                d, expire_at, ref, size = _SLOT_HEADER.unpack_from(self.map, off)
+                if d == digest:
+                    target = off
+                    break
+                if free is None and expire_at < now:
+                    free = off
+            if target is None:
+                target = free
+            if target is None:
+                #CLOCK: first slot without a second chance, clearing ref bits on the way
+                for off in xrange(bucket, bucket + length, self.slot_size):
+                    d, expire_at, ref, size = _SLOT_HEADER.unpack_from(self.map, off)
+                    if not ref:
+                        target = off
+                        break
+                    _SLOT_HEADER.pack_into(self.map, off, d, expire_at, 0, size)
+                if target is None:
+                    target = bucket
+                self.stats['evict'] += 1
+            _SLOT_HEADER.pack_into(self.map, target, digest, now + (ttl or self.ttl), 0, len(data))
+            start = target + _SLOT_HEADER.size
+            self.map[start:start + len(data)] = data
+        finally:
+            self._unlock(bucket, length)
+        self.stats['set'] += 1
+        return True
+
+    def delete(self, key):
+        digest = hashlib.md5(key).digest()
+        bucket = self._bucket(digest)
+        length = WAYS * self.slot_size
+        self._lock(bucket, length)
+        try:
+            for off in xrange(bucket, bucket + length, self.slot_size):
+                if _SLOT_HEADER.unpack_from(self.map, off)[0] == digest:
+                    _SLOT_HEADER.pack_into(self.map, off, '\0' * 16, 0.0, 0, 0)
+                    break
+        finally:
+            self._unlock(bucket, length)
+
+    def invalidate(self, tag):
+        offset = self._tag_offset(tag)
+        self._lock(offset, _TAG.size)
+        try:
+            _TAG.pack_into(self.map, offset, self._generation(offset) + 1)
+        finally:
+            self._unlock(offset, _TAG.size)
+
+    def clear(self):
+        self._lock(self.slots_offset, self.size - self.slots_offset)
+        try:
+            empty = '\0' * self.slot_size
+            for off in xrange(self.slots_offset, self.size, self.slot_size):
+                self.map[off:off + self.slot_size] = empty
+        finally:
+            self._unlock(self.slots_offset, self.size - self.slots_offset)
+
+_shared = {}
+
+def get_shared(ttl=60):
+    #one mapping per process and path, every local tier shares it
+    cache = _shared.get(SHM_CACHE_PATH)
+    if cache is None:
+        cache = _shared[SHM_CACHE_PATH] = SharedCache(ttl=ttl)
+    return cache
+
+if __name__ == '__main__':
+    import tempfile
+    import timeit
+
+    path = tempfile.mktemp()
+    c = SharedCache(path, slots=64, slot_size=512)
+    c.set('a', {'id': 1}, tags=['account:1'])
+    assert c.get('a') == {'id': 1}
+    c.invalidate('account:1')
+    assert c.get('a') is MISS
+    c.set('b', 2, ttl=-1)
+    assert c.get('b') is MISS
+    assert not c.set('c', 'x' * 1024)
+    for i in range(1000):
+        c.set('k%d' % i, i)
+    assert c.stats['evict'] > 0
+    os.remove(path)
+
+    n = 20000
+    value = {'id': 1, 'name': u'user_1', 'email': u'user_1@mydomain.com'}
+    path = tempfile.mktemp()
+    c = SharedCache(path)
+    print 'shm     set %.1fus  get %.1fus' % (
+        min(timeit.repeat(lambda: c.set('bench', value), number=n, repeat=3)) / n * 1e6,
+        min(timeit.repeat(lambda: c.get('bench'), number=n, repeat=3)) / n * 1e6)
+    os.remove(path)
+    try:
+        import redis
+        r = redis.Redis()
+        r.ping()
+    except Exception, e:
+        print 'redis on loopback not available:', e
+    else:
+        data = dumps(value)
+        print 'redis   set %.1fus  get %.1fus' % (
+            min(timeit.repeat(lambda: r.set('bench', data), number=n, repeat=3)) / n * 1e6,
+            min(timeit.repeat(lambda: loads(r.get('bench')), number=n, repeat=3)) / n * 1e6)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import time
+import hashlib
+import threading
+from functools import wraps
+
+from helpers import deadline
+from helpers.cache import dumps, loads
+from singletons import rds, REDIS_ERRORS
+
+#single flight for idempotent GET handlers
+#identical concurrent requests (path + args + account) share one computation:
+#threads of a worker wait on the leader's Event, other workers wait for the leader's result in redis
+
+IGNORED_ARGS = ('ip', 'ua_ip_hash', 'callback')
+
+_calls = {}
+_calls_lock = threading.Lock()
+_stats = {'leader': 0, 'follower': 0, 'shared': 0}
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.failed = False
+
+def make_key(f, args, me):
+    items = sorted((k, v) for k, v in args.iteritems() if k not in IGNORED_ARGS)
+    caller = me and (me['id'], bool(me.get('is_session_id'))) or None
+    digest = hashlib.md5(repr((items, caller))).hexdigest()
+    return 'singleflight:%s.%s:%s' % (f.__module__, f.__name__, digest)
+
+def _wait_for(key, timeout):
+    end = time.time() + timeout
+    while time.time() < end:
+        time.sleep(0.005)
+        data = rds.get(key)
+        if data is not None:
+            return loads(data)
+
+def _compute(f, key, args, me, meta, window, wait):
+    #cross worker: a short redis lock elects the leader, followers poll for its result
+    result_key = key + ':result'
+    try:
+        data = rds.get(result_key)
+        if data is not None:
+            _stats['shared'] += 1
+            return loads(data)
+        leader = rds.set(key + ':lock', 1, nx=True, px=int(wait * 1000))
+        if not leader:
+            left = deadline.remaining()
+            rlt = _wait_for(result_key, left is None and wait or min(wait, left))
+            if rlt is not None:
+                _stats['follower'] += 1
+                return rlt
+    except REDIS_ERRORS:
+        leader = False
+    _stats['leader'] += 1
+    before = dict(meta)
+    rlt = None
+    try:
+        res = f(args, me, meta)
+        rlt = res, dict((k, v) for k, v in meta.iteritems() if before.get(k, None) != v)
+    finally:
+        if leader:
+            try:
+                p = rds.pipeline()
+                if rlt is not None:
+                    p.set(result_key, dumps(rlt), px=int(window * 1000))
+                p.delete(key + ':lock')
+                p.execute()
+            except REDIS_ERRORS:
+                pass
+    return rlt
+
+def coalesce(window=1.0, wait=2.0):
+    #results are shared for window seconds, followers wait up to wait seconds before computing themselves
+    def decorator(f):
+        @wraps(f)
+        def wrapper(args, me, meta):
+            key = make_key(f, args, me)
+            with _calls_lock:
+                call = _calls.get(key)
+                leader = call is None
+                if leader:
+                    call = _calls[key] = _Call()
+            if not leader:
+                call.event.wait(wait)
+                if call.event.is_set() and not call.failed:
+                    _stats['follower'] += 1
+                    res, meta_updates = call.result
+                    meta.update(meta_updates)
+                    return res
+                return f(args, me, meta)
+            try:
+                call.result = _compute(f, key, args, me, meta, window, wait)
+            except:
+                call.failed = True
+                raise
+            finally:
+                with _calls_lock:
+                    _calls.pop(key, None)
+                call.event.set()
+            res, meta_updates = call.result
+            meta.update(meta_updates)
+            return res
+        return wrapper
+    return decorator
+
+def stats():
+    return dict(_stats)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import re
+from collections import OrderedDict
+
+#client side statement cache for singletons.MySQL
+#PyMySQL only speaks the text protocol, so there is no server side COM_STMT_PREPARE to cache.
+#instead hot statements are split into byte pieces once and ints skip the escaper,
+#which saves the query encode and %-format parse PyMySQL redoes on every execute
+
+_PLACEHOLDER_RE = re.compile(r'%s|%%')
+
+class Statement(object):
+
+    __slots__ = ('pieces', 'count')
+
+    def __init__(self, query, encoding):
+        if isinstance(query, unicode):
+            query = query.encode(encoding)
+        #text between %s placeholders, %% already folded to %
+        self.pieces = _split(query)
+        self.count = len(self.pieces) - 1
+
+    def render(self, conn, params):
+        if len(params) != self.count:
+            raise TypeError('not enough arguments for format string')
+        pieces = self.pieces
+        out = [pieces[0]]
+        for i, param in enumerate(params):
+            if type(param) in (int, long):
+                literal = str(param)
+            else:
+                literal = conn.literal(param)
+                if isinstance(literal, unicode):
+                    literal = literal.encode(conn.encoding)
+            out.append(literal)
+            out.append(pieces[i + 1])
+        return ''.join(out)
+
+def _split(query):
+    pieces = []
+    start = 0
+    current = []
+    for m in _PLACEHOLDER_RE.finditer(query):
+        current.append(query[start:m.start()])
+        if m.group() == '%%':
+            current.append('%')
+        else:
+            pieces.append(''.join(current))
+            current = []
+        start = m.end()
+    current.append(query[start:])
+    pieces.append(''.join(current))
+    return pieces
+
+class StatementCache(object):
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.statements = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, conn, query, params):
+        #None means the statement can't be cached (named params), use the normal path
+        if not isinstance(params, (tuple, list)) or '%(' in query:
+            return None
+        stmt = self.statements.pop(query, None)
+        if stmt is None:
+            self.misses += 1
+            stmt = Statement(query, conn.encoding)
+            if len(self.statements) >= self.maxsize:
+                self.statements.popitem(last=False)
+        else:
+            self.hits += 1
+        self.statements[query] = stmt
+        return stmt.render(conn, params)
+
+    def clear(self):
+        self.statements.clear()
+
+if __name__ == '__main__':
+    #tight get_account_by_id style loop against config.MYSQL, cache off then on
+    import sys
+    import os
+    import time
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    from singletons import mysql_conn
+
+    n = int(sys.argv[1:] and sys.argv[1] or 10000)
+    for statements in (None, StatementCache()):
+        mysql_conn.statements = statements
+        start = time.time()
+        for i in xrange(n):
+            mysql_conn.fetch_one('select * from users where id = %s limit 1', (i % 100 + 1, ))
+        cost = time.time() - start
+        print '%-9s %d queries  %.3fs  %.1fus/query' % (statements and 'cached' or 'uncached', n, cost, cost / n * 1e6)
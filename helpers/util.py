@@ -7,17 +7,24 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import re
 import datetime
 import time
-import random
 from decimal import Decimal
 import string
+import operator
 import calendar
 import base64
-from Crypto.Cipher import AES
-from Crypto import Random
-import requests
+import hmac
+import hashlib
 import urllib
 
 from helpers.error import error
+from helpers.rows import Row
+from helpers import deadline
+from helpers.lazy import LazyModule
+
+AES = LazyModule('Crypto.Cipher.AES')
+Random = LazyModule('Crypto.Random')
+strxor = LazyModule('Crypto.Util.strxor')
+requests = LazyModule('requests')
 
 def realize(obj):
     if isinstance(obj, dict):
@@ -25,6 +32,8 @@ def realize(obj):
         for k in obj:
             res[k] = realize(obj[k])
         return res
+    if isinstance(obj, Row):
+        return dict((k, realize(v)) for k, v in obj.iteritems())
     if isinstance(obj, (list, tuple)):
         return map(realize, obj)
     if isinstance(obj, datetime.datetime):
@@ -55,13 +64,52 @@ def str_to_datetime(s):
         pass
     return r
 
+EMAIL_RE = re.compile(r'^(?#Start of dot-atom)[-!#\$%&\'\*\+\/=\?\^_`{}\|~0-9A-Za-z]+(?:\.[-!#\$%&\'\*\+\/=\?\^_`{}\|~0-9A-Za-z]+)*(?#End of dot-atom)(?:@(?#Start of domain)[-0-9A-Za-z]+(?:\.[-0-9A-Za-z]+)+(?#End of domain))$')
+MOBILE_RE = re.compile(r'\d{11}')
+
 def validate_email(email):
-    r = r'^(?#Start of dot-atom)[-!#\$%&\'\*\+\/=\?\^_`{}\|~0-9A-Za-z]+(?:\.[-!#\$%&\'\*\+\/=\?\^_`{}\|~0-9A-Za-z]+)*(?#End of dot-atom)(?:@(?#Start of domain)[-0-9A-Za-z]+(?:\.[-0-9A-Za-z]+)+(?#End of domain))$'
-    return re.match(r, email)
+    return EMAIL_RE.match(email)
 
 def validate_mobile(mobile):
-    r = r'\d{11}'
-    return re.match(r, mobile)
+    return MOBILE_RE.match(mobile)
+
+#list validators return (cleaned, None) or (None, {index: error code}).
+#the common all valid case runs in map()/min()/max() at C speed, items are only walked one by one
+#to find the bad ones.
+
+def clean_int_list(values, low=None, high=None):
+    try:
+        cleaned = map(int, values)
+        if not cleaned or ((low is None or min(cleaned) >= low) and (high is None or max(cleaned) <= high)):
+            return cleaned, None
+    except (ValueError, TypeError):
+        pass
+    errors = {}
+    for i, value in enumerate(values):
+        try:
+            value = int(value)
+        except (ValueError, TypeError):
+            errors[i] = 10011
+            continue
+        if (low is not None and value < low) or (high is not None and value > high):
+            errors[i] = 10010
+    return None, errors
+
+def clean_pattern_list(values, pattern):
+    try:
+        matches = map(pattern.match, values)
+    except TypeError:
+        matches = [isinstance(value, basestring) and pattern.match(value) for value in values]
+    if all(matches):
+        return list(values), None
+    return None, dict((i, isinstance(values[i], basestring) and 10010 or 10011)
+                      for i, m in enumerate(matches) if not m)
+
+def clean_email_list(emails):
+    return clean_pattern_list(emails, EMAIL_RE)
+
+def clean_mobile_list(mobiles):
+    return clean_pattern_list(mobiles, MOBILE_RE)
 
 def htmlspecialchars(text, ent_quotes=False):
     if not text:
@@ -87,8 +135,8 @@ def remove_spaces(s):
     return re.sub(pattern, '', s)
 
 def generate_long_id():
-    time.sleep(0.000001) #magic
-    return int(time.time() * 1000000) * 100 + random.randrange(100)
+    from helpers.ids import next_id
+    return next_id()
 
 def get_today_timestamp():
     return calendar.timegm(datetime.date.today().timetuple())
@@ -101,9 +149,13 @@ def base64_url_encode(inp):
 
 class AESCipher:
 
-    def __init__( self, key ):
+    def __init__(self, key, deterministic=False):
         self.key = key
         self.BS = 16
+        #deterministic: the IV is a MAC of the value, so equal values encrypt equally and can be cached
+        self.deterministic = deterministic
+        self.iv_key = hashlib.sha256('iv' + key).digest()
+        self._ecb = None
 
     def pad(self, s):
         return s + (self.BS - len(s) % self.BS) * chr(self.BS - len(s) % self.BS)
@@ -111,17 +163,60 @@ class AESCipher:
     def unpad(self, s):
         return s[:-ord(s[len(s)-1:])]
 
+    def _block_cipher(self):
+        #CBC is chained by hand over one ECB cipher, the key schedule is computed once per instance
+        if self._ecb is None:
+            self._ecb = AES.new(self.key, AES.MODE_ECB)
+        return self._ecb
+
+    def _ivs(self, raws):
+        if self.deterministic:
+            return [hmac.new(self.iv_key, raw, hashlib.sha256).digest()[:16] for raw in raws]
+        data = Random.new().read(16 * len(raws))
+        return [data[i:i + 16] for i in xrange(0, len(data), 16)]
+
     def encrypt(self, raw):
-        raw = self.pad(raw)
-        iv = Random.new().read(AES.block_size)
-        cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        return base64.b64encode(iv + cipher.encrypt(raw))
+        return self.encrypt_many([raw])[0]
 
     def decrypt(self, enc):
-        enc = base64.b64decode(enc)
-        iv = enc[:16]
-        cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        return self.unpad(cipher.decrypt(enc[16:]))
+        return self.decrypt_many([enc])[0]
+
+    def encrypt_many(self, raws):
+        #round k encrypts the k-th block of every value still that long in a single ECB call
+        if not raws:
+            return []
+        ecb = self._block_cipher()
+        padded = [self.pad(raw) for raw in raws]
+        prev = self._ivs(raws)
+        out = [[iv] for iv in prev]
+        active = range(len(padded))
+        offset = 0
+        while active:
+            blocks = ecb.encrypt(strxor.strxor(
+                ''.join([padded[i][offset:offset + 16] for i in active]),
+                ''.join([prev[i] for i in active])))
+            for n, i in enumerate(active):
+                prev[i] = blocks[n * 16:n * 16 + 16]
+                out[i].append(prev[i])
+            offset += 16
+            active = [i for i in active if len(padded[i]) > offset]
+        return [base64.b64encode(''.join(parts)) for parts in out]
+
+    def decrypt_many(self, encs):
+        #CBC decryption has no chain: every block of every value goes through one ECB call
+        if not encs:
+            return []
+        encs = [base64.b64decode(enc) for enc in encs]
+        plain = strxor.strxor(
+            self._block_cipher().decrypt(''.join([enc[16:] for enc in encs])),
+            ''.join([enc[:-16] for enc in encs]))
+        res = []
+        offset = 0
+        for enc in encs:
+            size = len(enc) - 16
+            res.append(self.unpad(plain[offset:offset + size]))
+            offset += size
+        return res
 
 def get_total_seconds(td):
     return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 1e6) / 1e6
@@ -145,7 +240,8 @@ def partition(alist, indices):
     return [alist[i:j] for i, j in zip([0]+indices, indices+[None])]
 
 def download_file(url, filename):
-    r = requests.get(url, stream=True)
+    deadline.check()
+    r = requests.get(url, stream=True, timeout=deadline.http_timeout())
     with open(filename, 'wb') as f:
         for chunk in r.iter_content(chunk_size=1024):
             if chunk: # filter out keep-alive new chunks
@@ -153,7 +249,14 @@ def download_file(url, filename):
                 f.flush()
     return filename
 
+def _never(x, value):
+    return False
+
+def _is_in(x, choices):
+    return x in choices
+
 class RangeCheck:
+    #checks are (function, operand) pairs on module level functions, no closures per call
 
     def __init__(self, value, value_cast, allow_none=False):
         try:
@@ -167,46 +270,38 @@ class RangeCheck:
     def check(self):
         if self.allow_none and self.value is None:
             return self.value, False
-        result = all(ev(self.value) for ev in self.evaluation)
-        print type(self.value), self.value
-        return self.value, result
+        value = self.value
+        for f, operand in self.evaluation:
+            if not f(value, operand):
+                return value, False
+        return value, True
+
+    def _compare(self, f, value):
+        if type(self.value) != type(value):
+            f = _never
+        self.evaluation.append((f, value))
+        return self
 
     def is_one_of(self, choices):
         try:
-            choices_ = iter(choices)
+            iter(choices)
         except TypeError, e:
-            self.evaluation.append(lambda x: False)
+            self.evaluation.append((_never, None))
             return self
-        self.evaluation.append(lambda x: x in choices_)
+        self.evaluation.append((_is_in, choices))
         return self
 
     def min(self, value):
-        if type(self.value) != type(value):
-            self.evaluation.append(lambda x: False)
-            return self
-        self.evaluation.append(lambda x: x >= value)
-        return self
+        return self._compare(operator.ge, value)
 
     def max(self, value):
-        if type(self.value) != type(value):
-            self.evaluation.append(lambda x: False)
-            return self
-        self.evaluation.append(lambda x: x <= value)
-        return self
+        return self._compare(operator.le, value)
 
     def equals(self, value):
-        if type(self.value) != type(value):
-            self.evaluation.append(lambda x: False)
-            return self
-        self.evaluation.append(lambda x: x == value)
-        return self
+        return self._compare(operator.eq, value)
 
     def not_equal(self, value):
-        if type(self.value) != type(value):
-            self.evaluation.append(lambda x: False)
-            return self
-        self.evaluation.append(lambda x: x != value)
-        return self
+        return self._compare(operator.ne, value)
 
     def less_than(self, value):
         return self.min(value).not_equal(value)
@@ -226,3 +321,38 @@ if __name__ == '__main__':
     assert RangeCheck(1, int).min(1).check() == (1, True)
     assert RangeCheck(1, int).max(1).check() == (1, True)
     assert RangeCheck(1, int).within(1, 2).check() == (1, True)
+
+    import timeit
+    c = AESCipher('0123456789abcdef')
+    ids = [str(i) for i in xrange(10000)]
+    def encrypt_cbc(raw):
+        #one cipher and one RNG read per value, how encrypt used to work
+        iv = Random.new().read(AES.block_size)
+        return base64.b64encode(iv + AES.new(c.key, AES.MODE_CBC, iv).encrypt(c.pad(raw)))
+    def decrypt_cbc(enc):
+        enc = base64.b64decode(enc)
+        return c.unpad(AES.new(c.key, AES.MODE_CBC, enc[:16]).decrypt(enc[16:]))
+    assert c.decrypt_many(c.encrypt_many(ids)) == ids
+    assert c.decrypt(encrypt_cbc('x' * 40)) == 'x' * 40
+    assert decrypt_cbc(c.encrypt('x' * 40)) == 'x' * 40
+    assert c.decrypt_many(c.encrypt_many(['', 'a' * 16, 'b' * 33])) == ['', 'a' * 16, 'b' * 33]
+    d = AESCipher('0123456789abcdef', deterministic=True)
+    assert d.encrypt('1') == d.encrypt('1') != d.encrypt('2') and d.decrypt(d.encrypt('1')) == '1'
+    encrypted = c.encrypt_many(ids)
+    for name, f in (('encrypt one by one', lambda: [encrypt_cbc(i) for i in ids]),
+                    ('encrypt_many', lambda: c.encrypt_many(ids)),
+                    ('encrypt_many deterministic', lambda: d.encrypt_many(ids)),
+                    ('decrypt_many', lambda: c.decrypt_many(encrypted))):
+        print '%-28s 10k ids %.1fms' % (name, min(timeit.repeat(f, number=1, repeat=5)) * 1000)
+
+    assert clean_int_list(['1', 2, '3'], 1, 3) == ([1, 2, 3], None)
+    assert clean_int_list(['1', 'x', '0', None], 1) == (None, {1: 10011, 2: 10010, 3: 10011})
+    assert clean_email_list(['a@b.com', 'nope', 5]) == (None, {1: 10010, 2: 10011})
+    assert clean_mobile_list([]) == ([], None)
+    ints = [str(i) for i in xrange(1, 10001)]
+    emails = ['user_%d@mydomain.com' % i for i in xrange(10000)]
+    for name, f in (('ints one by one', lambda: [RangeCheck(x, str_to_int).within(1, 10000).check() for x in ints]),
+                    ('clean_int_list', lambda: clean_int_list(ints, 1, 10000)),
+                    ('emails one by one', lambda: [validate_email(x) for x in emails]),
+                    ('clean_email_list', lambda: clean_email_list(emails))):
+        print '%-28s 10k items %.1fms' % (name, min(timeit.repeat(f, number=1, repeat=5)) * 1000)
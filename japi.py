@@ -5,6 +5,8 @@ import sys
 reload(sys)
 sys.setdefaultencoding('utf8')
 
+import os
+import gc
 import imp
 import traceback
 import gzip
@@ -22,14 +24,41 @@ import config
 from helpers.error import *
 from helpers.util import realize
 from helpers import mail
-
-from singletons import mysql_conn, rds
+from helpers import codec
+from helpers import loader
+from helpers import deadline
+from helpers import response_cache
+from helpers import reloader
+from helpers import auth
+from helpers.api import compile_route
+from helpers.limiter import limiter, route_priority, route_key, queue_time
+from helpers.querylog import query_log
+
+from singletons import mysql_conn, rds, COLUMN_NAME_RE, REDIS_ERRORS
 from log import *
 
 exc = BaseException
 loaded_controllers = {}
 
+_local_limits = {'minute': None, 'counts': {}}
+
 def _check_limit_exceed(ua_ip_hash):
+    try:
+        return _check_limit_exceed_redis(ua_ip_hash)
+    except REDIS_ERRORS:
+        #redis is down, fail open on a per worker counter
+        return _check_limit_exceed_local(ua_ip_hash)
+
+def _check_limit_exceed_local(ua_ip_hash):
+    current_time = int(time.time() / 60)
+    if _local_limits['minute'] != current_time:
+        _local_limits['minute'] = current_time
+        _local_limits['counts'] = {}
+    counts = _local_limits['counts']
+    counts[ua_ip_hash] = counts.get(ua_ip_hash, 0) + 1
+    return counts[ua_ip_hash] > 1000
+
+def _check_limit_exceed_redis(ua_ip_hash):
     current_time = int(time.time() / 60) #per 60 seconds
     key = 'timelimit:%s%s' % (ua_ip_hash, current_time)
     current_limit = rds.get(key)
@@ -103,7 +132,85 @@ def _copy_dict_with_limited_value_length(o):
             res[k] = v
     return res
 
-def process_action(orig_path, args, me):
+def _parse_fields(fields):
+    #fields=a,b,c sparse fieldset, None means everything
+    if not fields:
+        return None
+    if isinstance(fields, (list, tuple)):
+        fields = ','.join(fields)
+    fields = [f.strip() for f in fields.split(',') if f.strip()]
+    if not fields:
+        return None
+    for f in fields:
+        if not COLUMN_NAME_RE.match(f):
+            error(10010, {'fields': f})
+    return fields
+
+def _load_controller(name):
+    m = loaded_controllers.get(name)
+    if m is None and name in sys.modules and hasattr(sys.modules[name], 'index'):
+        #already imported (a controller importing japi during warmup), don't execute it twice
+        m = loaded_controllers[name] = sys.modules[name]
+        if reloader.HOT_RELOAD:
+            reloader.track(name, m.__file__)
+    if m is None:
+        try:
+            m = imp.find_module(name, ['controllers'])
+        except ImportError, e:
+            return None
+
+        path = m[1]
+        m = imp.load_module(name, *m)
+        loaded_controllers[name] = m
+        if reloader.HOT_RELOAD:
+            reloader.track(name, path)
+    return m
+
+def _prepare_controller(m):
+    for api_line in getattr(m, 'ROUTES', {}).itervalues():
+        for api_line_items in api_line:
+            compile_route(api_line_items[0])
+    for method in ('GET', 'POST', 'PUT', 'DELETE'):
+        route_priority(m, method, '')
+        response_cache.lookup_rule(m, method, '')
+
+def _rss_kb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024
+    except (IOError, OSError, ValueError):
+        return 0
+
+def warmup():
+    #runs in the uwsgi master before fork so workers share controllers, compiled routes,
+    #templates and regexes copy-on-write instead of loading them on their first request
+    start = time.time()
+    rss = _rss_kb()
+    for name in sorted(os.listdir('controllers')):
+        if not name.endswith('.py') or name.startswith('_'):
+            continue
+        m = _load_controller(name[:-3])
+        if m is None:
+            continue
+        _prepare_controller(m)
+    mail.load_templates()
+    gc.collect()
+    if hasattr(gc, 'freeze'): #python 3.7+, keeps the collector from touching (and copying) the preloaded heap
+        gc.freeze()
+    debug_log.info('warmup\t%d controllers\t%.4f\t%dKB -> %dKB rss' % (len(loaded_controllers), time.time() - start, rss, _rss_kb()))
+
+def _response_cache_rule(path, args, me):
+    if args['REQUEST_METHOD'] != 'GET':
+        return None
+    r = path.strip('/').split('/')
+    m = _load_controller(r[0])
+    if m is None:
+        return None
+    rule = response_cache.lookup_rule(m, 'GET', '/'.join(r[1:]))
+    if rule and response_cache.applies(rule, me):
+        return rule
+
+def process_action(orig_path, args, me, queued=0.0):
     path = orig_path
     path = path.strip('/')
     r = path.split('/')
@@ -112,16 +219,10 @@ def process_action(orig_path, args, me):
         api_error = CustomError(10035)
         return _format_error(me, api_error), api_error
 
-    m = loaded_controllers.get(r[0])
+    m = _load_controller(r[0])
     if m is None:
-        try:
-            m = imp.find_module(r[0], ['controllers'])
-        except ImportError, e:
-            api_error = CustomError(10035)
-            return _format_error(me, api_error), api_error
-
-        m = imp.load_module(r[0], *m)
-        loaded_controllers[r[0]] = m
+        api_error = CustomError(10035)
+        return _format_error(me, api_error), api_error
     try:
         action = getattr(m, 'index')
     except:
@@ -132,26 +233,62 @@ def process_action(orig_path, args, me):
     else:
         args['URIARGS'] = '/'.join(r[1:])
 
+    try:
+        fields = _parse_fields(args.get('fields'))
+    except CustomError, api_error:
+        return _format_error(me, api_error), api_error
+
+    if not limiter.acquire(route_priority(m, args['REQUEST_METHOD'], args['URIARGS']), queued,
+                           route_key(m, args['REQUEST_METHOD'], args['URIARGS'])):
+        api_error = CustomError(90503)
+        return _format_error(me, api_error), api_error
+
     time1 = time.time()
     meta = {
         'version': 1,
         'update_db': False,
+        'fields': fields,
     }
 
     res = None
     api_error = None
+    query_count = mysql_conn.query_count
+    outermost = loader.current_scope() is None
+    if outermost:
+        query_log.begin_request(orig_path)
+    loader.open_scope()
+    deadline.start()
+    in_deadline = True
     try:
         res = action(args, me, meta)
+        meta['update_db'] = meta['update_db'] or mysql_conn.in_transaction
         mysql_conn.commit()
     except exc, e:
+        #error logging, the panic mail and the rollback must not be cut short by the request deadline
+        deadline.end()
+        in_deadline = False
         _log_error(orig_path, args, me, e)
         if not isinstance(e, CustomError):
             api_error = CustomError(10034, str(e))
         else:
             api_error = e
-        if meta['update_db']:
-            mysql_conn.conn.rollback()
+        meta['update_db'] = meta['update_db'] or mysql_conn.in_transaction
+        mysql_conn.rollback()
     finally:
+        limiter.release(time.time() - time1)
+        if in_deadline:
+            deadline.end()
+        scope = loader.close_scope()
+        if outermost:
+            mysql_conn.end_request()
+            query_log.end_request()
+        if getattr(config, 'DEBUG', False):
+            meta['db'] = {
+                'queries': mysql_conn.query_count - query_count,
+                'batches': scope['batches'],
+                'batched_keys': scope['keys'],
+                'loader_hits': scope['hits'],
+            }
         time2 = time.time()
         meta['cost'] = time2 - time1
         app_log.info('%s\t<%s>\t%.4f\t%s' % (
@@ -166,6 +303,8 @@ def process_action(orig_path, args, me):
             meta['cost'],
             urllib.urlencode(_copy_dict_with_limited_value_length(args)))
         )
+    #the fields projection is for handlers, it stays out of the response meta
+    meta.pop('fields', None)
     res = {
         'meta': meta,
         'data': res
@@ -200,6 +339,13 @@ def _build_args(environ):
             #print json_data
             for key, value in json_data.items():
                 args[key] = value
+        elif safe_env['CONTENT_TYPE'] == codec.MSGPACK_CONTENT_TYPE:
+            try:
+                msgpack_data = codec.decode_msgpack(post_data.file.read())
+            except:
+                return
+            for key, value in msgpack_data.items():
+                args[key] = value
         else:
             print safe_env['CONTENT_TYPE']
             return
@@ -222,13 +368,13 @@ def _build_args(environ):
 def _check_auth(environ):
     token = environ.get('HTTP_' + config.TOKEN_HEADER)
     if token:
-        acc = {'id': 0} #TODO: verify account
-        return acc
+        return auth.verify(token)
 
 def application(environ, start_response):
     response_header = '200 OK'
     headers = [('Access-Control-Allow-Origin', '*')]
     use_gzip = 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '').lower()
+    use_msgpack = codec.accepts_msgpack(environ)
     if environ['PATH_INFO'] == '/crossdomain.xml':
         res = '''<?xml version="1.0"?>
 <cross-domain-policy>
@@ -239,8 +385,11 @@ def application(environ, start_response):
         res = ''
         headers.append(('Content-Type', 'image/x-icon'))
     else:
+        if reloader.HOT_RELOAD:
+            reloader.reload_changed(loaded_controllers, _prepare_controller, debug_log)
         api_error = None
         me = None
+        cache_rule = None
         args = _build_args(environ)
         if args is None:
             api_error = CustomError(10002)
@@ -254,9 +403,9 @@ def application(environ, start_response):
                     api_error = CustomError(10030)
                     res = _format_error(me, api_error)
                 else:
-                    auth = _check_auth(environ)
-                    if auth:
-                        me = auth
+                    acc = _check_auth(environ)
+                    if acc:
+                        me = acc
                         if me.get('is_session_id'):
                             args['session_id'] = int(me['id'])
                     if 'force_auth' in args and not me:
@@ -264,7 +413,18 @@ def application(environ, start_response):
                         res = _format_error(me, api_error)
 
                 if not api_error:
-                    res, api_error = process_action(environ['PATH_INFO'], args, me)
+                    cache_rule = _response_cache_rule(environ['PATH_INFO'], args, me)
+                    if cache_rule:
+                        cache_key = response_cache.make_key(environ['PATH_INFO'], args, me, use_gzip, use_msgpack, cache_rule)
+                        cached = response_cache.fetch(cache_rule, cache_key)
+                        if cached:
+                            body, cached_headers, etag = cached
+                            if environ.get('HTTP_IF_NONE_MATCH') == etag:
+                                start_response('304 Not Modified', [])
+                                return {}
+                            start_response(response_header, cached_headers + [('Content-Length', str(len(body)))])
+                            return [body]
+                    res, api_error = process_action(environ['PATH_INFO'], args, me, queue_time(environ))
 
         if api_error:
             if api_error.code >= 20010 and api_error.code <= 26999:
@@ -274,6 +434,10 @@ def application(environ, start_response):
                 response_header = api_error.get_message()
             elif api_error.code == 10030:
                 response_header = '429 Too Many Requests'
+            elif api_error.code == 10037:
+                response_header = '504 Gateway Timeout'
+            elif api_error.code == 10038:
+                response_header = '503 Service Unavailable'
             else:
                 response_header = '500 Internal Server Error'
 
@@ -286,8 +450,9 @@ def application(environ, start_response):
                 headers.append(('Content-Type', 'text/plain; charset=utf-8'))
                 res = res['data']
 
-        res = json.dumps(realize(res))
-        headers.append(('Content-Type', 'application/json; charset=utf-8'))
+        res, content_type = codec.encode(realize(res), use_msgpack)
+        headers.append(('Content-Type', content_type))
+        headers.append(('Vary', 'Accept, Accept-Encoding'))
 
         etag = '"' + hashlib.md5(res).hexdigest()[:16] + '"'
         headers.append(('ETag', etag))
@@ -304,7 +469,13 @@ def application(environ, start_response):
             resio.seek(0)
             res = resio.read()
 
+        if cache_rule and not api_error:
+            response_cache.store(cache_rule, cache_key, res, list(headers), etag)
+
     content_length = len(res)
     headers.append(('Content-Length', str(content_length)))
     start_response(response_header, headers)
     return [res]
+
+if getattr(config, 'PRELOAD_CONTROLLERS', True):
+    warmup()
@@ -8,31 +8,51 @@ def get_logger(lname, fname=None, size=512*1024*1024, count=50, fmt='[%(asctime)
     l = logger.getLogger(filename=config.LOG_PATH + fname, level=logger.DEBG, fmt=fmt, maxbytes=size, backups=count, when='midnight')
     return l
 
-error_log = get_logger(
+class LazyLogger(object):
+    #builds the logger (and opens its files) on first use instead of at import time
+
+    def __init__(self, factory, *args, **kwargs):
+        self._factory = factory
+        self._args = args
+        self._kwargs = kwargs
+        self._logger = None
+
+    def __getattr__(self, attr):
+        if self._logger is None:
+            self._logger = self._factory(*self._args, **self._kwargs)
+        return getattr(self._logger, attr)
+
+error_log = LazyLogger(get_logger,
     'error',
     count=10,
     fmt='[%(asctime)s] [%(levelname)s] (#%(pid)d %(function)s %(filename)s:%(lineno)d) %(message)s\n',
     datefmt="%Y-%m-%d %H:%M:%S"
 )
-panic_log = get_logger(
+panic_log = LazyLogger(get_logger,
     'panic',
     count=10,
     fmt='[%(asctime)s] [%(levelname)s] (#%(pid)d %(function)s %(filename)s:%(lineno)d) %(message)s\n',
     datefmt="%Y-%m-%d %H:%M:%S"
 )
-app_log = get_logger(
+app_log = LazyLogger(get_logger,
     'app',
     count=10000,
     fmt='[%(asctime)s] [%(levelname)s] (#%(pid)d %(function)s %(filename)s:%(lineno)d) %(message)s\n',
     datefmt="%Y-%m-%d %H:%M:%S"
 )
-debug_log = get_logger(
+debug_log = LazyLogger(get_logger,
     'debug',
     count=90,
     fmt='[%(asctime)s] [%(levelname)s] (#%(pid)d %(function)s %(filename)s:%(lineno)d) %(message)s\n',
     datefmt="%Y-%m-%d %H:%M:%S"
 )
-maillog = logger.getLogger(
+slow_log = LazyLogger(get_logger,
+    'slow',
+    count=10,
+    fmt='[%(asctime)s] %(message)s\n',
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+maillog = LazyLogger(logger.getLogger,
     filename='logs/mail.log',
     level=logger.DEBG,
     fmt='[%(asctime)s] %(message)s\n',
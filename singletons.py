@@ -4,45 +4,317 @@ import config
 import pymysql
 import redis
 import time
+import re
+import os
+import socket
+import tempfile
 
-rds = redis.Redis(**config.REDIS)
+from helpers.error import error
+from helpers.querylog import query_log
+from helpers.rows import make_rows
+from helpers.statements import StatementCache
+from helpers import deadline
+from helpers.breaker import CircuitBreaker, CircuitOpen
 
-class MySQL():
+COLUMN_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+SELECT_RE = re.compile(r'^\s*select\b', re.I)
+LOCKING_READ_RE = re.compile(r'\bfor\s+update\b|\block\s+in\s+share\s+mode\b', re.I)
+
+PACKET_MARGIN = 1024
+MAX_EXECUTION_TIME_HINT = getattr(config, 'MYSQL_MAX_EXECUTION_TIME_HINT', True)
+DEADLINE_SLACK = 0.5
+STATEMENT_CACHE_SIZE = getattr(config, 'MYSQL_STATEMENT_CACHE', 0) #0 disables
+
+REPLICA_MAX_LAG = getattr(config, 'MYSQL_REPLICA_MAX_LAG', 5)
+REPLICA_CHECK_INTERVAL = getattr(config, 'MYSQL_REPLICA_CHECK_INTERVAL', 5)
+
+#pymysql raises OperationalError for any unmapped server errno too (1054, 1205, 1213, 3024...),
+#only these mean the server is unreachable or the connection is gone
+MYSQL_CONNECTION_ERRNOS = (2002, 2003, 2006, 2013)
+MYSQL_CONNECTION_ERRORS = (pymysql.OperationalError, pymysql.InterfaceError, socket.error)
+
+def is_connection_error(e):
+    if isinstance(e, pymysql.OperationalError):
+        return bool(e.args) and e.args[0] in MYSQL_CONNECTION_ERRNOS
+    return isinstance(e, (pymysql.InterfaceError, socket.error))
+
+def is_unavailable(e):
+    return isinstance(e, CircuitOpen) or is_connection_error(e)
+
+class Redis(redis.Redis):
+    #every command and pipeline goes through the redis breaker, an outage fails fast with CircuitOpen
+
+    def __init__(self, *args, **kwargs):
+        super(Redis, self).__init__(*args, **kwargs)
+        self.breaker = CircuitBreaker('redis', errors=(redis.ConnectionError, redis.TimeoutError))
+
+    def execute_command(self, *args, **options):
+        return self.breaker.call(super(Redis, self).execute_command, *args, **options)
+
+    def pipeline(self, *args, **kwargs):
+        p = super(Redis, self).pipeline(*args, **kwargs)
+        execute = p.execute
+        p.execute = lambda *a, **kw: self.breaker.call(execute, *a, **kw)
+        return p
+
+REDIS_ERRORS = (redis.ConnectionError, redis.TimeoutError, CircuitOpen)
+
+#redis-py fixes socket timeouts per connection, so they are bounded by the default request deadline
+rds = Redis(**dict({
+    'socket_timeout': min(getattr(config, 'REDIS_SOCKET_TIMEOUT', 1.0), deadline.REQUEST_DEADLINE),
+    'socket_connect_timeout': min(getattr(config, 'REDIS_CONNECT_TIMEOUT', 1.0), deadline.REQUEST_DEADLINE),
+}, **config.REDIS))
+
+class Replica():
 
     def __init__(self, config):
+        config = dict(config)
+        self.weight = config.pop('weight', 1)
+        self.config = config
+        self.name = '%s:%s' % (config.get('host', 'localhost'), config.get('port', 3306))
+        self.db = None
+        #one breaker per replica for the life of the process, connections come and go
+        self.breaker = CircuitBreaker('mysql:' + self.name, errors=MYSQL_CONNECTION_ERRORS, is_failure=is_connection_error)
+        self.current_weight = 0
+        self.lag = None
+        self.lag_checked = 0
+        self.ejected_until = 0
+        self.stats = {'queries': 0, 'errors': 0, 'time': 0.0}
+
+    def get_db(self):
+        if self.db is None:
+            self.db = self.breaker.call(MySQL, self.config, name=self.name, breaker=self.breaker)
+        return self.db
+
+    def eject(self, now):
+        self.ejected_until = now + REPLICA_CHECK_INTERVAL
+
+    def check_lag(self, now):
+        self.lag_checked = now
+        try:
+            status = self.get_db().fetch_one('show slave status', None)
+        except pymysql.MySQLError, e:
+            print e, 'replica check error', self.name
+            self.stats['errors'] += 1
+            self.eject(now)
+            return
+        #a plain server (no replication configured) counts as caught up
+        if status is None:
+            self.lag = 0
+        else:
+            self.lag = status.get('Seconds_Behind_Master')
+        if self.lag is None or self.lag > REPLICA_MAX_LAG:
+            self.eject(now)
+
+    def available(self, now):
+        if now < self.ejected_until:
+            return False
+        if self.breaker.is_open():
+            return False
+        if now - self.lag_checked > REPLICA_CHECK_INTERVAL:
+            self.check_lag(now)
+        return now >= self.ejected_until
+
+    def fetch(self, method, query, params, compact=False):
+        #a query the primary retries after this replica failed counts as a primary query only
+        start = time.time()
+        try:
+            rlt = getattr(self.get_db(), method)(query, params, compact)
+        except MYSQL_CONNECTION_ERRORS + (CircuitOpen, ), e:
+            #query errors (bad column, deadlock) say nothing about the replica's health
+            if is_unavailable(e):
+                self.stats['errors'] += 1
+                self.eject(time.time())
+            else:
+                self.stats['queries'] += 1
+            raise
+        finally:
+            self.stats['time'] += time.time() - start
+        self.stats['queries'] += 1
+        return rlt
+
+    def get_stats(self):
+        return dict(self.stats, name=self.name, weight=self.weight, lag=self.lag,
+                    ejected=self.ejected_until > time.time())
+
+class MySQL():
+
+    def __init__(self, config, replicas=None, name='primary', breaker=None):
         self.config = config
-        self.conn = pymysql.connect(**config)
+        self.breaker = breaker or CircuitBreaker('mysql:' + name, errors=MYSQL_CONNECTION_ERRORS, is_failure=is_connection_error)
+        self.conn = self._connect()
         self.timestamp = time.time()
+        self.query_count = 0
+        self.in_transaction = False
+        self.replicas = [Replica(r) for r in replicas or []]
+        self.sticky = False
+        self.max_allowed_packet = None
+        self.statements = STATEMENT_CACHE_SIZE and StatementCache(STATEMENT_CACHE_SIZE) or None
+
+    def _connect(self):
+        #autocommit by default, a transaction is only opened by the first write of a request
+        conn_config = dict(self.config)
+        conn_config.setdefault('autocommit', True)
+        return pymysql.connect(**conn_config)
 
     def reconnect(self):
+        #only between transactions: a fresh connection would run the rest of a broken transaction in autocommit
+        if self.in_transaction:
+            if not self.conn.open:
+                raise pymysql.OperationalError(2013, 'Lost connection to MySQL server during transaction')
+            return 0
         flag = 0
         new_ts = time.time()
-        if new_ts - self.timestamp > 7200:
+        if new_ts - self.timestamp > 7200 or not self.conn.open:
+            self.breaker.before()
+            if self.conn.open:
+                try:
+                    self.conn.close()
+                except pymysql.OperationalError, e:
+                    print e, 'reconnect error'
             try:
-                self.conn.close()
-            except pymysql.OperationalError, e:
-                print e, 'reconnect error'
-            self.conn = pymysql.connect(**self.config)
+                self.conn = self._connect()
+            except MYSQL_CONNECTION_ERRORS:
+                self.breaker.failure()
+                raise
+            self.breaker.success()
+            self.in_transaction = False
+            self.max_allowed_packet = None
+            if self.statements is not None:
+                self.statements.clear()
             flag = 1
         self.timestamp = new_ts
         return flag
 
+    def quote_names(self, names):
+        for name in names:
+            if not COLUMN_NAME_RE.match(name):
+                raise ValueError('invalid column name: %r' % name)
+        return ', '.join('`%s`' % n for n in names)
+
+    def columns(self, fields=None, required=(), allowed=None):
+        #turn a fields= projection into an explicit select list, '*' when not projecting.
+        #allowed is the table's column list, unknown fields are a client error and never reach mysql
+        if not fields:
+            return '*'
+        if allowed is None:
+            raise ValueError('columns() needs the allowed column list to project fields')
+        names = list(required)
+        for f in fields:
+            if f not in allowed:
+                error(10010, {'fields': f})
+            if f not in names:
+                names.append(f)
+        return self.quote_names(names)
+
+    def _execute(self, cur, query, params):
+        left = deadline.check()
+        sql, sql_params = query, params
+        if self.statements is not None and params is not None:
+            rendered = self.statements.render(self.conn, query, params)
+            if rendered is not None:
+                sql, sql_params = rendered, None
+        if left is not None:
+            #the remaining request budget bounds the query, server side for selects, socket reads and writes for everything
+            if MAX_EXECUTION_TIME_HINT:
+                sql = SELECT_RE.sub('select /*+ MAX_EXECUTION_TIME(%d) */' % max(int(left * 1000), 1), sql, 1)
+            saved = self._set_timeout(left + DEADLINE_SLACK, left + DEADLINE_SLACK)
+        start = time.time()
+        try:
+            return self.breaker.call(cur.execute, sql, sql_params)
+        except pymysql.OperationalError:
+            deadline.check()
+            raise
+        finally:
+            if left is not None:
+                self._set_timeout(*saved)
+            query_log.record(query, params, time.time() - start, self._explain)
+
+    def _set_timeout(self, read, write):
+        #pymysql sets the socket timeout from _read_timeout/_write_timeout before every read and write,
+        #returns the previous pair to restore
+        conn = self.conn
+        saved = getattr(conn, '_read_timeout', None), getattr(conn, '_write_timeout', None)
+        conn._read_timeout = read
+        conn._write_timeout = write
+        sock = getattr(conn, '_sock', None)
+        if sock is not None:
+            sock.settimeout(read)
+        return saved
+
+    def _explain(self, query, params):
+        cur = self.conn.cursor(pymysql.cursors.DictCursor)
+        cur.execute('explain ' + query, params)
+        rlt = list(cur.fetchall())
+        cur.close()
+        return rlt
+
+    def _read_replica(self):
+        #smooth weighted round robin over healthy replicas, primary after a write (read your writes)
+        if not self.replicas or self.sticky or self.in_transaction:
+            return None
+        now = time.time()
+        best = None
+        total = 0
+        for replica in self.replicas:
+            if not replica.available(now):
+                continue
+            replica.current_weight += replica.weight
+            total += replica.weight
+            if best is None or replica.current_weight > best.current_weight:
+                best = replica
+        if best is not None:
+            best.current_weight -= total
+        return best
+
+    def end_request(self):
+        self.sticky = False
+
+    def node_stats(self):
+        replicas = [replica.get_stats() for replica in self.replicas]
+        primary = {'name': 'primary', 'queries': self.query_count - sum(r['queries'] for r in replicas)}
+        return [primary] + replicas
+
+    def begin(self):
+        self.sticky = True
+        if not self.in_transaction:
+            self.reconnect()
+            self.conn.begin()
+            self.in_transaction = True
+
     def commit(self):
-        self.reconnect()
-        self.conn.commit()
+        #read only requests never opened a transaction, skip the round trip
+        if self.in_transaction:
+            self.conn.commit()
+            self.in_transaction = False
+
+    def rollback(self):
+        #runs on error paths: a connection pymysql closed after a read timeout has nothing to roll back
+        if self.in_transaction:
+            self.in_transaction = False
+            if not self.conn.open:
+                return
+            try:
+                self.conn.rollback()
+            except (pymysql.InterfaceError, pymysql.OperationalError), e:
+                print e, 'rollback error'
 
     def execute_once(self, query, params):
+        self.begin()
         self.reconnect()
+        self.query_count += 1
         cur = self.conn.cursor()
-        result = cur.execute(query, params)
+        result = self._execute(cur, query, params)
         cur.nextset()
         cur.close()
         return result
 
     def insert_and_get_id(self, query, params):
+        self.begin()
         self.reconnect()
+        self.query_count += 1
         cur = self.conn.cursor()
-        result = cur.execute(query, params)
+        result = self._execute(cur, query, params)
         last_id = None
         if result:
             last_id = self.conn.insert_id()
@@ -50,26 +322,145 @@ class MySQL():
         cur.close()
         return last_id
 
-    def fetch_one(self, query, params):
+    def fetch_one(self, query, params, compact=False):
+        if LOCKING_READ_RE.search(query):
+            self.begin()
+        replica = self._read_replica()
+        self.query_count += 1
+        if replica is not None:
+            try:
+                return replica.fetch('fetch_one', query, params, compact)
+            except MYSQL_CONNECTION_ERRORS + (CircuitOpen, ), e:
+                if not is_unavailable(e):
+                    raise
+                print e, 'replica error, falling back to primary', replica.name
         self.reconnect()
-        cur = self.conn.cursor(pymysql.cursors.DictCursor)
-        result = cur.execute(query, params)
+        if compact:
+            cur = self.conn.cursor()
+        else:
+            cur = self.conn.cursor(pymysql.cursors.DictCursor)
+        result = self._execute(cur, query, params)
         if not result:
             return
         rlt = cur.fetchone()
+        if compact:
+            rlt = make_rows(cur.description, [rlt])[0]
         cur.nextset()
         cur.close()
         return rlt
 
-    def fetch_all(self, query, params):
+    def fetch_all(self, query, params, compact=False):
+        if LOCKING_READ_RE.search(query):
+            self.begin()
+        replica = self._read_replica()
+        self.query_count += 1
+        if replica is not None:
+            try:
+                return replica.fetch('fetch_all', query, params, compact)
+            except MYSQL_CONNECTION_ERRORS + (CircuitOpen, ), e:
+                if not is_unavailable(e):
+                    raise
+                print e, 'replica error, falling back to primary', replica.name
         self.reconnect()
-        cur = self.conn.cursor(pymysql.cursors.DictCursor)
-        result = cur.execute(query, params)
+        #compact returns Row objects sharing one header instead of a dict per row
+        if compact:
+            cur = self.conn.cursor()
+        else:
+            cur = self.conn.cursor(pymysql.cursors.DictCursor)
+        result = self._execute(cur, query, params)
         if not result:
             return []
-        rlt = list(cur.fetchall())
+        if compact:
+            rlt = make_rows(cur.description, cur.fetchall())
+        else:
+            rlt = list(cur.fetchall())
         cur.nextset()
         cur.close()
         return rlt
 
-mysql_conn = MySQL(config.MYSQL)
+    def get_max_allowed_packet(self):
+        if self.max_allowed_packet is None:
+            cur = self.conn.cursor()
+            cur.execute('select @@max_allowed_packet', None)
+            self.max_allowed_packet = int(cur.fetchone()[0])
+            cur.close()
+        return self.max_allowed_packet
+
+    def bulk_insert(self, table, columns, rows, update=None, ignore=False):
+        #multi row insert chunked under max_allowed_packet, update=[cols] turns it into an upsert
+        #returns (first_id, last_id) per chunk, only meaningful for plain inserts on auto increment
+        #tables with innodb_autoinc_lock_mode 0 or 1
+        head = 'insert %sinto %s (%s) values ' % (ignore and 'ignore ' or '', self.quote_names([table]), self.quote_names(columns))
+        tail = ''
+        if update:
+            self.quote_names(update)
+            tail = ' on duplicate key update ' + ', '.join('`%s` = values(`%s`)' % (c, c) for c in update)
+        self.begin()
+        self.reconnect()
+        limit = self.get_max_allowed_packet() - len(head) - len(tail) - PACKET_MARGIN
+        id_ranges = []
+        chunk = []
+        size = 0
+        for row in rows:
+            value = self.conn.escape(tuple(row))
+            #escape returns unicode for unicode values, the packet limit counts encoded bytes
+            n = len(isinstance(value, unicode) and value.encode(self.conn.encoding) or value) + 1
+            if chunk and size + n > limit:
+                id_ranges.append(self._insert_chunk(head, chunk, tail))
+                chunk = []
+                size = 0
+            chunk.append(value)
+            size += n
+        if chunk:
+            id_ranges.append(self._insert_chunk(head, chunk, tail))
+        return id_ranges
+
+    def _insert_chunk(self, head, chunk, tail):
+        self.query_count += 1
+        cur = self.conn.cursor()
+        result = self._execute(cur, head + ','.join(chunk) + tail, None)
+        first_id = self.conn.insert_id()
+        cur.close()
+        return first_id, first_id and first_id + result - 1
+
+    def load_data(self, table, columns, rows):
+        #LOAD DATA LOCAL INFILE for very large loads, needs local_infile=True in config.MYSQL
+        #rows are streamed from the iterator into a temporary file, never held in memory
+        f = tempfile.NamedTemporaryFile(prefix='load_data_', suffix='.tsv', delete=False)
+        try:
+            for row in rows:
+                f.write('\t'.join(_infile_value(v) for v in row) + '\n')
+            f.close()
+            self.begin()
+            self.reconnect()
+            self.query_count += 1
+            cur = self.conn.cursor()
+            result = self._execute(cur, 'load data local infile %%s into table %s character set utf8 (%s)' % (
+                self.quote_names([table]), self.quote_names(columns)), (f.name, ))
+            cur.close()
+            return result
+        finally:
+            f.close()
+            os.unlink(f.name)
+
+def _infile_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+mysql_conn = MySQL(config.MYSQL, getattr(config, 'MYSQL_REPLICAS', None))
+
+if __name__ == '__main__':
+    #throughput of bulk_insert against config.MYSQL: python singletons.py 1000 100000 1000000
+    import sys
+    mysql_conn.execute_once('create temporary table bulk_bench (id int unsigned not null auto_increment primary key, name varchar(32), score int)', None)
+    for n in map(int, sys.argv[1:] or ['1000', '100000']):
+        start = time.time()
+        ranges = mysql_conn.bulk_insert('bulk_bench', ['name', 'score'], (('name_%d' % i, i) for i in xrange(n)))
+        mysql_conn.commit()
+        cost = time.time() - start
+        print '%8d rows  %3d chunks  %.3fs  %d rows/s' % (n, len(ranges), cost, n / cost)